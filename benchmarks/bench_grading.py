@@ -0,0 +1,286 @@
+"""
+Benchmark for the answer-grading hot path in utils/math_utils.py.
+
+No grading corpus ships with the repo: it is built from your own infer.py outputs, which are not checked in,
+so `run` and `check` take the --corpus written by `build`.
+
+    # collect (model answer, ground truth) pairs from real infer.py outputs, with today's verdicts as reference
+    python3 -m benchmarks.bench_grading build --results data/aime/*/modified_16.json --out benchmarks/grading_corpus.jsonl
+    # throughput, per-call p50/p99 latency and time per grading stage
+    python3 -m benchmarks.bench_grading run --corpus benchmarks/grading_corpus.jsonl
+    # check that a (faster) grader reproduces the recorded verdicts exactly
+    python3 -m benchmarks.bench_grading check --corpus benchmarks/grading_corpus.jsonl --grader utils.math_utils:grade_answer_sympy
+    # same for a batched grader, called once per problem with all of its answers
+    python3 -m benchmarks.bench_grading check --corpus benchmarks/grading_corpus.jsonl --grader utils.math_utils:grade_many --batched
+    # check _normalize against the recorded fuzz/replay outputs and report its speedup over the recorded baseline
+    python3 -m benchmarks.bench_grading normalize --corpus benchmarks/normalize_corpus.jsonl
+"""
+import sys
+import json
+import random
+import time
+import argparse
+import importlib
+from pathlib import Path
+from collections import defaultdict
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+from utils import math_utils
+from utils.extract import extract_last_boxed_text
+from utils.load_metadata import load_metadata_by_key
+from utils.results_io import load_results
+
+console = Console()
+# Functions of utils.math_utils timed by `run`; times are inclusive, so nested stages also count in their callers.
+STAGES = ["_normalize", "_parse_latex", "split_tuple", "are_equal_under_sympy", "_sympy_parse"]
+
+
+def load_grader(spec: str):
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name or "grade_answer_sympy")
+
+
+def load_corpus(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def grading_calls(corpus, grader, batched):
+    """
+    Yield (pairs, call) where call() grades `pairs` and returns one verdict per pair: one pair per call, or with
+    `batched` all pairs of a problem in a single grader(answers, ground_truth) call, as eval_pipeline.py makes them.
+    """
+    if not batched:
+        for pair in corpus:
+            yield [pair], lambda pair=pair: [grader(pair["given"], pair["ground_truth"])]
+        return
+    problems = defaultdict(list)
+    for pair in corpus:
+        problems[(pair["source"], json.dumps(pair["ground_truth"]))].append(pair)
+    for pairs in problems.values():
+        yield pairs, lambda pairs=pairs: grader([pair["given"] for pair in pairs], pairs[0]["ground_truth"])
+
+
+def build(args) -> None:
+    metadata = {}
+    seen = set()
+    n_pairs = 0
+    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as fout:
+        for results_file in args.results:
+            # data/{data_type}/{model}/{type_flag}_..._{n}.json[l]
+            parts = Path(results_file).parts
+            data_type, type_flag = parts[-3], Path(results_file).name.split("_")[0]
+            if data_type == "puzzle":
+                continue  # graded by the LLM judge, not by grade_answer_sympy
+            if data_type not in metadata:
+                metadata[data_type] = load_metadata_by_key(data_type)
+            for problem_id, resp in load_results(results_file).items():
+                if problem_id not in metadata[data_type]:
+                    continue
+                ground_truth = metadata[data_type][problem_id][f"{type_flag}_answer"]
+                # same answer selection as eval_pipeline.py
+                if "reasoning" in resp and resp["reasoning"][0] != "":
+                    model_reasoning = resp["reasoning"]
+                else:
+                    model_reasoning = resp["raw"]
+                for r, a in zip(model_reasoning, resp["answer"]):
+                    given = extract_last_boxed_text(r) if not len(a) else a
+                    key = (given, json.dumps(ground_truth))
+                    if args.dedup and key in seen:
+                        continue
+                    seen.add(key)
+                    correct, gt_normalized, given_normalized = math_utils.grade_answer_sympy(given, ground_truth)
+                    fout.write(json.dumps({
+                        "given": given,
+                        "ground_truth": ground_truth,
+                        "correct": bool(correct),
+                        "gt_normalized": gt_normalized,
+                        "given_normalized": given_normalized,
+                        "source": f"{results_file}:{problem_id}",
+                    }, ensure_ascii=False) + "\n")
+                    n_pairs += 1
+                    if args.max_pairs and n_pairs >= args.max_pairs:
+                        console.print(f"[bold green]Wrote {n_pairs} pairs to {args.out}")
+                        return
+    console.print(f"[bold green]Wrote {n_pairs} pairs to {args.out}")
+
+
+def _timed(fn, totals, counts, name):
+    def wrapper(*a, **kw):
+        start = time.perf_counter_ns()
+        try:
+            return fn(*a, **kw)
+        finally:
+            totals[name] += time.perf_counter_ns() - start
+            counts[name] += 1
+    return wrapper
+
+
+def run(args) -> None:
+    corpus = load_corpus(args.corpus)
+    grader = load_grader(args.grader)
+    totals, counts = defaultdict(int), defaultdict(int)
+    originals = {name: getattr(math_utils, name) for name in STAGES if hasattr(math_utils, name)}
+    for name, fn in originals.items():
+        setattr(math_utils, name, _timed(fn, totals, counts, name))
+    latencies = []
+    calls = list(grading_calls(corpus, grader, args.batched))
+    math_utils.EQUIVALENCE_TIERS.clear()
+    try:
+        wall_start = time.perf_counter()
+        for _ in range(args.repeat):
+            for _, call in calls:
+                start = time.perf_counter_ns()
+                call()
+                latencies.append(time.perf_counter_ns() - start)
+        wall = time.perf_counter() - wall_start
+    finally:
+        for name, fn in originals.items():
+            setattr(math_utils, name, fn)
+
+    latencies = np.array(latencies) / 1e3  # microseconds
+    table = Table(title=f"{args.grader} on {len(corpus)} pairs x {args.repeat}")
+    table.add_column("Metric")
+    table.add_column("Value", justify="right")
+    table.add_row("calls", str(len(latencies)))
+    table.add_row("throughput (calls/s)", f"{len(latencies) / wall:.1f}")
+    table.add_row("throughput (pairs/s)", f"{len(corpus) * args.repeat / wall:.1f}")
+    table.add_row("p50 latency (us)", f"{np.percentile(latencies, 50):.1f}")
+    table.add_row("p99 latency (us)", f"{np.percentile(latencies, 99):.1f}")
+    table.add_row("max latency (us)", f"{latencies.max():.1f}")
+    console.print(table)
+
+    stages = Table(title="Time per stage (inclusive)")
+    stages.add_column("Stage")
+    stages.add_column("Calls", justify="right")
+    stages.add_column("Total (s)", justify="right")
+    stages.add_column("Share of wall", justify="right")
+    for name in originals:
+        stages.add_row(name, str(counts[name]), f"{totals[name] / 1e9:.3f}", f"{100 * totals[name] / 1e9 / wall:.1f}%")
+    console.print(stages)
+
+    tiers = Table(title="Pairs settled per equivalence tier")
+    tiers.add_column("Tier")
+    tiers.add_column("Pairs", justify="right")
+    for tier, count in math_utils.EQUIVALENCE_TIERS.most_common():
+        tiers.add_row(tier, str(count))
+    console.print(tiers)
+
+
+def check(args) -> None:
+    corpus = load_corpus(args.corpus)
+    grader = load_grader(args.grader)
+    verdict_mismatches, form_mismatches = [], 0
+    for pairs, call in grading_calls(corpus, grader, args.batched):
+        for pair, (correct, gt_normalized, given_normalized) in zip(pairs, call()):
+            if bool(correct) != pair["correct"]:
+                verdict_mismatches.append((pair, correct))
+            if (gt_normalized, given_normalized) != (pair["gt_normalized"], pair["given_normalized"]):
+                form_mismatches += 1
+    for pair, correct in verdict_mismatches[:args.show]:
+        console.print(f"[red]mismatch[/] {pair['source']}: given={pair['given']!r} gt={pair['ground_truth']!r} "
+                      f"expected={pair['correct']} got={bool(correct)}")
+    console.print(f"{len(corpus)} pairs: {len(verdict_mismatches)} verdict mismatches, "
+                  f"{form_mismatches} normalized-form mismatches")
+    if verdict_mismatches or (args.strict and form_mismatches):
+        sys.exit(1)
+
+
+# Pieces the fuzzer glues together: every rewrite _normalize knows about, plus typical answer fragments.
+FUZZ_TOKENS = [
+    "\\text{", "\\text{ ", "}", "{", "\\frac", "\\dfrac", "\\tfrac", "{1}{2}", "12", "3", "7 3/4", "0.5", ".5", "1,000",
+    "1,000,000", ",\\!", ",", "\\sqrt", "\\sqrt{2}", "\\pi", "\\infty", "\\cup", "\\cdot", "\\times", "\\left(", "\\right)",
+    "(", ")", "[", "]", "^", "^2", "^{2}", "^\\circ", "^ \\circ", "\\%", "%", "\\$", "$", " or ", " and ", "million", "billion",
+    "trillion", "s_n =", "d =", "degrees", "cm", "centimeters", "meters", "miles", "seconds", "minutes", "hour", "days",
+    "weeks", "months", "years", "foot", "feet", "inches", "yards", "cm^2", "x", "y", "Yes", "NO", "-", "- ", "+", "/", " ",
+    "\\boxed{", "\\mathbf{", "\\,", "\\!", "\\\\", "10^{6}", "2.0", "-3.00", "1e3", "\\{", "\\}",
+]
+
+
+def fuzz_inputs(n, seed=0, corpus=None):
+    rng = random.Random(seed)
+    inputs = []
+    if corpus:
+        for pair in load_corpus(corpus):
+            inputs.append(pair["given"])
+            if isinstance(pair["ground_truth"], str):
+                inputs.append(pair["ground_truth"])
+    for _ in range(n):
+        inputs.append("".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(1, 8))))
+    return list(dict.fromkeys(inputs))
+
+
+def _time_normalize(inputs, repeat):
+    """Mean microseconds per call over `repeat` passes, each starting from an empty `_parse_latex` cache."""
+    elapsed = 0.0
+    for _ in range(repeat):
+        if hasattr(math_utils._parse_latex, "cache_clear"):
+            math_utils._parse_latex.cache_clear()
+        start = time.perf_counter()
+        for expr in inputs:
+            math_utils._normalize(expr)
+        elapsed += time.perf_counter() - start
+    return elapsed / (repeat * len(inputs)) * 1e6
+
+
+def normalize(args) -> None:
+    if args.record:
+        inputs = fuzz_inputs(args.fuzz, seed=args.seed, corpus=args.from_corpus)
+        us_per_call = _time_normalize(inputs, args.repeat)
+        with open(args.corpus, "w", encoding="utf-8") as fout:
+            fout.write(json.dumps({"meta": {"baseline_us_per_call": us_per_call}}) + "\n")
+            for expr in inputs:
+                fout.write(json.dumps({"input": expr, "expected": math_utils._normalize(expr)}, ensure_ascii=False) + "\n")
+        console.print(f"[bold green]Recorded {len(inputs)} inputs to {args.corpus} ({us_per_call:.1f} us/call)")
+        return
+
+    records = load_corpus(args.corpus)
+    meta = records[0]["meta"] if "meta" in records[0] else {}
+    records = [r for r in records if "input" in r]
+    mismatches = [r for r in records if math_utils._normalize(r["input"]) != r["expected"]]
+    for r in mismatches[:args.show]:
+        console.print(f"[red]mismatch[/] {r['input']!r}: expected {r['expected']!r}, got {math_utils._normalize(r['input'])!r}")
+    us_per_call = _time_normalize([r["input"] for r in records], args.repeat)
+    baseline = meta.get("baseline_us_per_call")
+    speedup = f", {baseline / us_per_call:.1f}x vs recorded baseline ({baseline:.1f} us/call)" if baseline else ""
+    console.print(f"{len(records)} inputs: {len(mismatches)} mismatches; {us_per_call:.1f} us/call{speedup}")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    sub = p.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="collect (answer, ground truth) pairs and reference verdicts from result files")
+    p_build.add_argument("--results", type=str, nargs="+", required=True)
+    p_build.add_argument("--out", type=str, default="benchmarks/grading_corpus.jsonl")
+    p_build.add_argument("--dedup", action="store_true", help="keep each (answer, ground truth) pair once")
+    p_build.add_argument("--max_pairs", type=int, default=0)
+
+    p_run = sub.add_parser("run", help="measure throughput, latency and time per stage")
+    p_run.add_argument("--corpus", type=str, required=True, help="written by `build`")
+    p_run.add_argument("--grader", type=str, default="utils.math_utils:grade_answer_sympy")
+    p_run.add_argument("--repeat", type=int, default=1)
+    p_run.add_argument("--batched", action="store_true", help="grader takes (answers, ground_truth); call it once per problem")
+
+    p_check = sub.add_parser("check", help="verify a grader reproduces the recorded verdicts")
+    p_check.add_argument("--corpus", type=str, required=True, help="written by `build`")
+    p_check.add_argument("--grader", type=str, default="utils.math_utils:grade_answer_sympy")
+    p_check.add_argument("--batched", action="store_true", help="grader takes (answers, ground_truth); call it once per problem")
+    p_check.add_argument("--strict", action="store_true", help="also fail on differing normalized forms")
+    p_check.add_argument("--show", type=int, default=20, help="mismatches to print")
+
+    p_norm = sub.add_parser("normalize", help="check _normalize against recorded outputs, or record them with --record")
+    p_norm.add_argument("--corpus", type=str, default="benchmarks/normalize_corpus.jsonl")
+    p_norm.add_argument("--record", action="store_true", help="write fuzz (and replay) inputs with today's outputs")
+    p_norm.add_argument("--from_corpus", type=str, default=None, help="grading corpus whose answers are added to --record")
+    p_norm.add_argument("--fuzz", type=int, default=3000, help="random inputs generated by --record")
+    p_norm.add_argument("--seed", type=int, default=0)
+    p_norm.add_argument("--repeat", type=int, default=3)
+    p_norm.add_argument("--show", type=int, default=20, help="mismatches to print")
+
+    args = p.parse_args()
+    {"build": build, "run": run, "check": check, "normalize": normalize}[args.command](args)
@@ -0,0 +1,93 @@
+"""
+Throughput of the LLM judge against the local fake server (or any OpenAI-compatible --base_url).
+
+    # utils/judge.py: one async client, --concurrency in flight, token bucket of --rate requests/s
+    python3 -m benchmarks.bench_judge --requests 2000 --latency 0.2 --server_rps 100
+    # the previous scheme: a new sync OpenAI client per request from 10 processes
+    python3 -m benchmarks.bench_judge --requests 200 --latency 0.2 --baseline
+    # 2000 calls over 300 distinct prompts: identical calls in flight share one request
+    python3 -m benchmarks.bench_judge --requests 2000 --distinct 300
+"""
+import time
+import asyncio
+import argparse
+import multiprocessing as mp
+import numpy as np
+from openai import OpenAI
+from rich.console import Console
+from rich.table import Table
+from benchmarks.fake_openai_server import start_server
+from utils.judge import Judge
+
+console = Console()
+
+
+def fake_messages(i):
+    return [{"role": "user", "content": f"Is answer {i} correct? Answer in true or false."}]
+
+
+async def run_judge(args, base_url):
+    judge = Judge(model="gpt-4o-mini", base_url=base_url, api_key="fake", concurrency=args.concurrency, rate=args.rate,
+                  cache_dir=None)
+    latencies = []
+
+    async def one(i):
+        start = time.perf_counter()
+        await judge.ask(fake_messages(i % args.distinct))
+        latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    await judge.close()
+    return latencies, judge.stats
+
+
+def _baseline_one(args):
+    i, base_url = args
+    start = time.perf_counter()
+    client = OpenAI(api_key="fake", base_url=base_url)
+    client.chat.completions.create(model="gpt-4o-mini", messages=fake_messages(i))
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--requests", type=int, default=1000)
+    p.add_argument("--distinct", type=int, default=0, help="number of distinct prompts; 0 for all distinct")
+    p.add_argument("--base_url", type=str, default=None, help="judge this server instead of starting the fake one")
+    p.add_argument("--latency", type=float, default=0.2, help="fake server: mean seconds per completion")
+    p.add_argument("--server_rps", type=int, default=0, help="fake server: requests per second before 429s")
+    p.add_argument("--error_rate", type=float, default=0.0, help="fake server: fraction of 500s")
+    p.add_argument("--concurrency", type=int, default=64)
+    p.add_argument("--rate", type=float, default=100.0, help="judge token bucket, requests/s")
+    p.add_argument("--baseline", action="store_true", help="one sync client per request from 10 processes instead")
+    args = p.parse_args()
+    args.distinct = args.distinct or args.requests
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server, base_url = start_server(latency=args.latency, rps=args.server_rps, error_rate=args.error_rate)
+
+    start = time.perf_counter()
+    if args.baseline:
+        with mp.Pool(processes=10) as pool:
+            latencies = pool.map(_baseline_one, [(i % args.distinct, base_url) for i in range(args.requests)])
+        stats = {}
+    else:
+        latencies, stats = asyncio.run(run_judge(args, base_url))
+    wall = time.perf_counter() - start
+
+    latencies = np.array(latencies)
+    table = Table(title=f"{'baseline' if args.baseline else 'async judge'}: {args.requests} requests")
+    table.add_column("Metric")
+    table.add_column("Value", justify="right")
+    table.add_row("throughput (requests/s)", f"{args.requests / wall:.1f}")
+    table.add_row("p50 latency (s)", f"{np.percentile(latencies, 50):.3f}")
+    table.add_row("p99 latency (s)", f"{np.percentile(latencies, 99):.3f}")
+    for name, value in stats.items():
+        table.add_row(f"judge {name}", str(value))
+    if server is not None:
+        for name, value in server.RequestHandlerClass.state.stats.items():
+            table.add_row(f"server {name}", str(value))
+        server.shutdown()
+    console.print(table)
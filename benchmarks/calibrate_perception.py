@@ -0,0 +1,79 @@
+"""
+Agreement of multi-sample perception judging (eval_pipeline.py --perception_chunk_size N) with the per-sample mode.
+
+    python3 -m benchmarks.calibrate_perception --data_type aime --model qwen3_8b_think --type_flag modified \
+        --chunk_sizes 4 8 16 --max_problems 30
+
+Judges the same samples once per sample and once per chunk, then reports, per chunk size, the agreement with
+per-sample verdicts, Cohen's kappa, the confusion counts, and API requests, prompt tokens and wall-clock per problem.
+Replies go through the judge cache like eval_pipeline.py (so the per-sample verdicts of an earlier evaluation
+are reused); pass --judge_cache_dir "" to measure cost and time from scratch.
+"""
+import time
+import asyncio
+import argparse
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+from eval_pipeline import EvalPipeline
+from utils.judge import JUDGE_CACHE_DIR, Judge, validate_cache_dir
+
+console = Console()
+
+
+def cohen_kappa(a: np.ndarray, b: np.ndarray) -> float:
+    observed = (a == b).mean()
+    expected = a.mean() * b.mean() + (1 - a.mean()) * (1 - b.mean())
+    return (observed - expected) / (1 - expected) if expected < 1 else 1.0
+
+
+async def judge_all(perception_args, chunk_size, args):
+    judge = Judge(model=args.judge_model, base_url=args.judge_base_url, concurrency=args.judge_concurrency,
+                  rate=args.judge_rps, cache_dir=args.judge_cache_dir)
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(EvalPipeline.evaluate_perception(judge, a, chunk_size) for a in perception_args))
+    finally:
+        await judge.close()
+    verdicts = np.array([v for perceptions, _ in results for v in perceptions], dtype=bool)
+    return verdicts, judge.stats, time.perf_counter() - start
+
+
+async def main(args):
+    _, perception_args = EvalPipeline.load_inputs(args.data_type, args.model, args.type_flag)
+    perception_args = perception_args[:args.max_problems]
+    n = len(perception_args)
+    reference, reference_stats, reference_wall = await judge_all(perception_args, 1, args)
+
+    table = Table(title=f"Perception: chunked vs per-sample on {n} problems, {len(reference)} samples")
+    for column in ["Chunk", "Agreement", "Kappa", "TT / TF / FT / FF", "Requests", "Prompt tok/problem", "Wall/problem (s)"]:
+        table.add_column(column, justify="right")
+    table.add_row("1", "-", "-", f"{reference.sum()} true", str(reference_stats["requests"]),
+                  f"{reference_stats['prompt_tokens'] / n:.0f}", f"{reference_wall / n:.2f}")
+    for chunk_size in args.chunk_sizes:
+        verdicts, stats, wall = await judge_all(perception_args, chunk_size, args)
+        confusion = " / ".join(str(int(((reference == r) & (verdicts == v)).sum()))
+                               for r, v in [(True, True), (True, False), (False, True), (False, False)])
+        table.add_row(str(chunk_size), f"{(verdicts == reference).mean():.3f}", f"{cohen_kappa(reference, verdicts):.3f}",
+                      confusion, str(stats["requests"]), f"{stats['prompt_tokens'] / n:.0f}", f"{wall / n:.2f}")
+    console.print(table)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--data_type", type=str, default="aime", choices=["aime", "math500", "puzzle"])
+    p.add_argument("--model", type=str, required=True)
+    p.add_argument("--type_flag", type=str, default="modified", choices=["modified", "original"])
+    p.add_argument("--chunk_sizes", type=int, nargs="+", default=[4, 8, 16])
+    p.add_argument("--max_problems", type=int, default=30)
+    p.add_argument("--judge_model", type=str, default="gpt-4o-mini")
+    p.add_argument("--judge_base_url", type=str, default=None)
+    p.add_argument("--judge_concurrency", type=int, default=64)
+    p.add_argument("--judge_rps", type=float, default=20)
+    p.add_argument("--judge_cache_dir", type=str, default=JUDGE_CACHE_DIR)
+    args = p.parse_args()
+    try:
+        validate_cache_dir(args.judge_base_url, args.judge_cache_dir)
+    except ValueError as e:
+        p.error(str(e))
+    asyncio.run(main(args))
@@ -0,0 +1,268 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, to exercise utils/judge.py without the real API.
+
+    python3 -m benchmarks.fake_openai_server --port 8001 --latency 0.2 --rps 50 --error_rate 0.01
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake python3 eval_pipeline.py --judge_cache_dir cache/judge_fake ...
+
+Replies "true" or "false" (a fixed function of the prompt, so repeated runs agree) after a random delay around
+--latency. Requests beyond --rps in the current second get a 429 with a Retry-After header, and a fraction
+--error_rate get a 500. GET /stats returns the request counters and the peak number of concurrent requests.
+
+The Batch API is emulated too: POST /v1/files uploads a request file, POST /v1/batches starts a batch that is
+"completed" --batch_delay seconds later, and GET /v1/files/{id}/content returns its output (a fraction
+--batch_error_rate of the requests go to the error file instead). Files and batches only live in memory.
+"""
+import json
+import time
+import itertools
+import random
+import hashlib
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIState:
+    def __init__(self, latency=0.2, rps=0, error_rate=0.0, retry_after=1.0, batch_delay=2.0, batch_error_rate=0.0, seed=0):
+        self.latency = latency
+        self.batch_delay = batch_delay
+        self.batch_error_rate = batch_error_rate
+        self.files = {}  # id -> (filename, purpose, bytes)
+        self.batches = {}  # id -> batch object
+        self.ids = itertools.count()
+        self.rps = rps
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = (0, 0)  # (second, requests admitted in it)
+        self.in_flight = 0
+        self.stats = {"requests": 0, "completed": 0, "rate_limited": 0, "errors": 0, "peak_in_flight": 0,
+                      "batches": 0, "batch_requests": 0}
+
+    def admit(self):
+        """None if the request may proceed, else the HTTP status to fail it with."""
+        with self.lock:
+            self.stats["requests"] += 1
+            second = int(time.monotonic())
+            start, count = self.window if self.window[0] == second else (second, 0)
+            if self.rps and count >= self.rps:
+                self.stats["rate_limited"] += 1
+                return 429
+            self.window = (start, count + 1)
+            if self.rng.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return 500
+            self.in_flight += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+            return None
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.stats["completed"] += 1
+
+    def add_file(self, filename, purpose, data):
+        with self.lock:
+            file_id = f"file-{next(self.ids)}"
+            self.files[file_id] = (filename, purpose, data)
+        return file_object(file_id, filename, purpose, data)
+
+    def create_batch(self, body):
+        with self.lock:
+            batch_id = f"batch_{next(self.ids)}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body.get("completion_window", "24h"),
+                "status": "in_progress",
+                "created_at": int(time.time()),
+                "output_file_id": None,
+                "error_file_id": None,
+                "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            }
+            self.stats["batches"] += 1
+            return dict(self.batches[batch_id])
+
+    def retrieve_batch(self, batch_id):
+        """The batch, completed (and its output written) once --batch_delay has passed since it was created."""
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= self.batch_delay:
+                self._finish_batch(batch)
+            return dict(batch)
+
+    def _finish_batch(self, batch):
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]][2].splitlines() if line.strip()]
+        output, errors = [], []
+        for line in lines:
+            if self.rng.random() < self.batch_error_rate:
+                errors.append({"id": f"batch_req_{next(self.ids)}", "custom_id": line["custom_id"], "response": None,
+                               "error": {"code": "server_error", "message": "The server had an error"}})
+            else:
+                output.append({"id": f"batch_req_{next(self.ids)}", "custom_id": line["custom_id"], "error": None,
+                               "response": {"status_code": 200, "request_id": "fake", "body": completion(line["body"])}})
+        for key, records in (("output_file_id", output), ("error_file_id", errors)):
+            if records:
+                file_id = f"file-{next(self.ids)}"
+                data = "".join(json.dumps(r) + "\n" for r in records).encode()
+                self.files[file_id] = (f"{batch['id']}_{key}.jsonl", "batch_output", data)
+                batch[key] = file_id
+        batch["status"] = "completed"
+        batch["request_counts"] = {"total": len(lines), "completed": len(output), "failed": len(errors)}
+        self.stats["batch_requests"] += len(lines)
+
+
+def verdict_for(body: dict) -> str:
+    prompt = json.dumps(body.get("messages", []), sort_keys=True)
+    return "true" if hashlib.sha256(prompt.encode()).digest()[0] % 2 == 0 else "false"
+
+
+def file_object(file_id, filename, purpose, data):
+    return {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed"}
+
+
+def reply_for(body: dict) -> str:
+    """"true"/"false", or for a json_schema response_format an object with a boolean for every property."""
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") != "json_schema":
+        return verdict_for(body)
+    properties = response_format["json_schema"]["schema"]["properties"]
+    return json.dumps({key: verdict_for({"messages": body.get("messages", []), "key": key}) == "true" for key in properties})
+
+
+def completion(body):
+    # roughly 4 characters per token
+    prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+    content = reply_for(body)
+    completion_tokens = len(content) // 4 + 1
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    state: FakeOpenAIState = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload, headers=()):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _raw_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _body(self):
+        return json.loads(self._raw_body() or b"{}")
+
+    def _not_found(self):
+        self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_GET(self):
+        parts = self.path.rstrip("/").split("/")
+        if parts[-1] == "stats":
+            self._send(200, self.state.stats)
+        elif parts[-2] == "batches" and parts[-1] in self.state.batches:
+            self._send(200, self.state.retrieve_batch(parts[-1]))
+        elif parts[-1] == "content" and parts[-2] in self.state.files:
+            data = self.state.files[parts[-2]][2]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._not_found()
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path.endswith("/files"):
+            self.upload_file()
+        elif path.endswith("/batches"):
+            self._send(200, self.state.create_batch(self._body()))
+        elif path.endswith("/chat/completions"):
+            self.chat_completion()
+        else:
+            self._not_found()
+
+    def upload_file(self):
+        # multipart/form-data with a "file" and a "purpose" field
+        head = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        form = BytesParser(policy=default_policy).parsebytes(head + self._raw_body())
+        fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+        file = fields["file"]
+        purpose = fields["purpose"].get_payload(decode=True).decode()
+        self._send(200, self.state.add_file(file.get_filename(), purpose, file.get_payload(decode=True)))
+
+    def chat_completion(self):
+        body = self._body()
+        failure = self.state.admit()
+        if failure == 429:
+            self._send(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                       headers=[("Retry-After", f"{self.state.retry_after:g}")])
+            return
+        if failure == 500:
+            self._send(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+            return
+        try:
+            time.sleep(self.state.latency * random.uniform(0.5, 1.5))
+            self._send(200, completion(body))
+        finally:
+            self.state.release()
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the default backlog of 5 resets connections when many clients connect at once
+
+
+def start_server(port=0, **state_kwargs):
+    """Serve in a background thread; returns (server, base_url). Stop it with server.shutdown()."""
+    handler = type("FakeOpenAIHandler", (Handler,), {"state": FakeOpenAIState(**state_kwargs)})
+    server = Server(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, default=8001)
+    p.add_argument("--latency", type=float, default=0.2, help="mean seconds per completion")
+    p.add_argument("--rps", type=int, default=0, help="requests admitted per second before 429s; 0 for no limit")
+    p.add_argument("--retry_after", type=float, default=1.0, help="Retry-After sent with 429s")
+    p.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    p.add_argument("--batch_delay", type=float, default=2.0, help="seconds until a batch is completed")
+    p.add_argument("--batch_error_rate", type=float, default=0.0, help="fraction of batch requests that fail")
+    args = p.parse_args()
+    server, url = start_server(args.port, latency=args.latency, rps=args.rps, error_rate=args.error_rate,
+                               retry_after=args.retry_after, batch_delay=args.batch_delay,
+                               batch_error_rate=args.batch_error_rate)
+    print(f"Serving fake OpenAI API at {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
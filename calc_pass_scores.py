@@ -5,6 +5,7 @@ import json
 import os
 import sys
 import numpy as np
+from utils import passk
 
 def calculate_scores(data):
     total_numerator_p = 0
@@ -16,34 +17,38 @@ def calculate_scores(data):
 
     # For error bars
     p_pass_at_1_list = []
-    pass_at_1_list = []
     perception_ratio_list = []
+    # per-problem pass@1 = c / n
+    pass_at_1_list = np.nan_to_num(passk.pass_at_k([instance["passk"]["correct"] for instance in data.values()], [1])[:, 0])
 
     for instance in data.values():
         perception = instance["perception"]
         correct = instance["passk"]["correct"]
         assert len(perception) == len(correct), f"Length mismatch between perception {len(perception)} and correct {len(correct)}"
+        # infer.py --adaptive draws a different number of samples per problem; weight every problem equally
+        # (identical to the plain per-sample totals when all problems have the same number of samples).
+        num_samples = instance["passk"].get("num_samples", len(correct))
+        weight = 1 / num_samples if num_samples > 0 else 0
 
         # p-pass@1
         numerator_p = sum(int(c) * int(p) for c, p in zip(correct, perception))
         denominator_p = sum(int(p) for p in perception)
         p_pass_at_1_list.append((numerator_p / denominator_p) if denominator_p > 0 else 0)
-        total_numerator_p += numerator_p
-        total_denominator_p += denominator_p
+        total_numerator_p += numerator_p * weight
+        total_denominator_p += denominator_p * weight
 
         # normal pass@1
         numerator = sum(int(c) for c in correct)
         denominator = len(correct)
-        pass_at_1_list.append((numerator / denominator) if denominator > 0 else 0)
-        total_numerator += numerator
-        total_denominator += denominator
+        total_numerator += numerator * weight
+        total_denominator += denominator * weight
 
         # perception ratio
         perception_true = sum(int(p) for p in perception)
         perception_count = len(perception)
         perception_ratio_list.append((perception_true / perception_count) if perception_count > 0 else 0)
-        total_perception_true += perception_true
-        total_perception_count += perception_count
+        total_perception_true += perception_true * weight
+        total_perception_count += perception_count * weight
 
     p_pass_at_1 = (total_numerator_p / total_denominator_p) if total_denominator_p > 0 else 0
     pass_at_1 = (total_numerator / total_denominator) if total_denominator > 0 else 0
@@ -65,6 +70,12 @@ def calculate_scores(data):
             pass_at_1_mean, pass_at_1_se,
             perception_ratio_mean, perception_ratio_se)
 
+
+def calculate_passk(data, ks=passk.DEFAULT_KS):
+    """Mean pass@k over problems with a bootstrap 95% CI, for every k that some problem has enough samples for."""
+    values = passk.pass_at_k([instance["passk"]["correct"] for instance in data.values()], ks)
+    return passk.aggregate(values, ks)
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python calc_pass_scores.py <json_path>")
@@ -77,6 +88,9 @@ if __name__ == "__main__":
     p_pass_at_1_mean, p_pass_at_1_se, \
     pass_at_1_mean, pass_at_1_se, \
     perception_ratio_mean, perception_ratio_se = calculate_scores(data)
+    # pass@1 is already reported above, with its SE
+    passk_lines = "".join(f"pass@{k}: {v['mean']:.4f} (95% CI: {v['ci_low']:.4f}-{v['ci_high']:.4f})\n"
+                          for k, v in calculate_passk(data).items() if k != 1)
     dataset = "aime" if "aime" in json_path else "math500"
     model = json_path.split('/')[-1][:-5]
     console = Console()
@@ -86,6 +100,7 @@ if __name__ == "__main__":
         f"p-pass@1: {p_pass_at_1:.4f} (mean: {p_pass_at_1_mean:.4f}, SE: {p_pass_at_1_se:.4f})\n"
         f"pass@1: {pass_at_1:.4f} (mean: {pass_at_1_mean:.4f}, SE: {pass_at_1_se:.4f})\n"
         f"perception ratio: {perception_ratio:.4f} (mean: {perception_ratio_mean:.4f}, SE: {perception_ratio_se:.4f})\n"
+        f"{passk_lines}"
         f"latex table: {p_pass_at_1*100:.2f}\\scriptsize{{$\\pm${p_pass_at_1_se*100:.2f}}} & {pass_at_1*100:.2f}\\scriptsize{{$\\pm${pass_at_1_se*100:.2f}}} & {perception_ratio*100:.2f}\\scriptsize{{$\\pm${perception_ratio_se*100:.2f}}}"
     )
     console.print(Panel(content, title="Results", border_style="blue"))
\ No newline at end of file
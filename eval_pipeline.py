@@ -3,16 +3,25 @@ dotenv.load_dotenv(override=True)
 import os
 import json
 import re
+import math
+import contextlib
+import time
 import glob
+import asyncio
 import argparse
-from openai import OpenAI
+import threading
 from pathlib import Path
-import multiprocessing as mp
+import numpy as np
 from tqdm import tqdm
-from utils.math_utils import grade_answer_sympy
+from tqdm.asyncio import tqdm as atqdm
+from utils import grade_cache, math_utils, passk
+from utils.grade_cache import grade_answer_cached
+from utils.judge import JUDGE_CACHE_DIR, Judge, validate_cache_dir
 from models import MODELS
 from utils.extract import extract_last_boxed_text
 from utils.load_metadata import load_metadata_by_key
+from utils.results_io import append_record, checkpoint_path, load_results, load_stage_results
+from utils.worker_pool import SupervisedPool
 # Configure logging
 # logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -29,16 +38,54 @@ Ground truth:
 """
 
 
+PERCEPTION_MULTI_PROMPT = """
+Evaluate, for each of the model outputs below, whether a part of it is similar to the ground truth solution.
+The ground truth solution is provided as a list of reasoning steps.
+Even if a model output is not exactly the same as the ground truth,
+it should be considered correct if a subset of the model output contains reasoning steps that are similar to any of the ground truth steps.
+Judge every model output on its own.
+
+The question is:
+{question}
+
+The ground truth solution is:
+{gt_step}
+
+The model outputs are:
+{model_outputs}
+
+For every model output i, set sample_i to true or false.
+"""
+
+
+def truncate_sample(model_raw):
+    """The part of a sample the perception judge sees: its first 15 paragraphs."""
+    return "\n\n".join(model_raw.split("\n\n")[:15])
+
+
+def perception_schema(num_samples):
+    """json_schema response format with one required boolean sample_i per sample."""
+    keys = [f"sample_{i + 1}" for i in range(num_samples)]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "perception",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {key: {"type": "boolean"} for key in keys},
+                "required": keys,
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
 class EvalPipeline:        
     @staticmethod
-    def evaluate_perception(args):
-        model_raw, gt_reason, question, problem_id = args
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        perceptions = []
-        for i in range(len(model_raw)):
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
+    def perception_messages(model_raw, gt_reason, question):
+        """Judge request asking whether one sample's reasoning contains steps of the ground-truth solution."""
+        return [
                 {"role": "user", "content": """
                 Evaluate whether a part of the model output is similar to the ground truth solution.
                 The ground truth solution is provided as a list of reasoning steps.
@@ -57,157 +104,474 @@ class EvalPipeline:
                 
                 
                 Answer in true or false.
-            """.format(question=question, gt_step=gt_reason, model_answer="\n\n".join(model_raw[i].split("\n\n")[:15]))
-            }],
-            )
-            gpt4o_output = response.choices[0].message.content.strip().lower()
-            tf = gpt4o_output == "true"
-            perceptions.append(tf)
+            """.format(question=question, gt_step=gt_reason, model_answer=truncate_sample(model_raw))
+            }]
+
+    @staticmethod
+    def perception_multi_messages(model_raws, gt_reason, question):
+        """Judge request covering several samples of one problem, which then share the question and solution."""
+        model_outputs = "\n\n".join(
+            f"<model_output_{i + 1}>\n{truncate_sample(raw)}\n</model_output_{i + 1}>" for i, raw in enumerate(model_raws)
+        )
+        return [{"role": "user", "content": PERCEPTION_MULTI_PROMPT.format(
+            question=question, gt_step=gt_reason, model_outputs=model_outputs)}]
+
+    @staticmethod
+    def perception_requests(model_raw, gt_reason, question, chunk_size=1):
+        """
+        (messages, params, sample indices) of every judge call for one problem's perception: one call per sample,
+        or with chunk_size > 1 one call per chunk_size samples that answers with a boolean per sample.
+        """
+        if chunk_size <= 1:
+            return [(EvalPipeline.perception_messages(raw, gt_reason, question), {}, [i]) for i, raw in enumerate(model_raw)]
+        requests = []
+        for start in range(0, len(model_raw), chunk_size):
+            chunk = model_raw[start:start + chunk_size]
+            requests.append((
+                EvalPipeline.perception_multi_messages(chunk, gt_reason, question),
+                {"response_format": perception_schema(len(chunk))},
+                list(range(start, start + len(chunk))),
+            ))
+        return requests
+
+    @staticmethod
+    async def evaluate_perception(judge, args, chunk_size=1):
+        model_raw, gt_reason, question, problem_id = args
+        perceptions = [None] * len(model_raw)
+
+        async def judge_request(messages, params, indices):
+            if not params:
+                perceptions[indices[0]] = await judge.ask(messages)
+                return
+            verdicts = await judge.ask_json(messages, **params)
+            verdicts = verdicts if isinstance(verdicts, dict) else {}
+            for j, i in enumerate(indices):
+                verdict = verdicts.get(f"sample_{j + 1}")
+                if not isinstance(verdict, bool):
+                    # malformed reply: ask about this sample on its own
+                    verdict = await judge.ask(EvalPipeline.perception_messages(model_raw[i], gt_reason, question))
+                perceptions[i] = verdict
+
+        await asyncio.gather(*(
+            judge_request(*request) for request in EvalPipeline.perception_requests(model_raw, gt_reason, question, chunk_size)
+        ))
         return perceptions, problem_id
 
     @staticmethod
-    def evaluate_passk(args):
-        
-        model_answer, gt_answer, problem_id = args
-        correct, gts, answers = zip(*[grade_answer_sympy(ans, gt_answer) for ans in model_answer])
-        gt_answer = gts[0]
+    def init_grade_worker(grade_cache_dir, sympy_guards):
+        """Pool initializer: grading settings of the command line, which a forkserver worker does not inherit."""
+        grade_cache.GRADE_CACHE_DIR = grade_cache_dir
+        math_utils.SYMPY_GUARDS = sympy_guards
+
+    @staticmethod
+    def grade_sample(args):
+        model_answer, gt_answer = args
+        return grade_answer_cached(model_answer, gt_answer)
+
+    @staticmethod
+    def summarize_passk(graded, model_answer, gt_answer):
+        """
+        One problem's pass@k record (correct, verdicts, gt_answer, answers, num_samples) from its per-sample
+        grading results, each ("ok", grade_answer_sympy output), ("timeout", None) or ("error", message) as reported
+        by the supervised grading pool. The pass@k values themselves are added later by `add_passk`.
+        Samples that timed out or errored count as incorrect and keep their status in results['verdicts'].
+        """
+        correct = [status == "ok" and bool(value[0]) for status, value in graded]
+        verdicts = [("correct" if c else "incorrect") if status == "ok" else status for c, (status, _) in zip(correct, graded)]
+        gts = [value[1] for status, value in graded if status == "ok"]
+        gt_answer = gts[0] if gts else gt_answer
+        answers = [value[2] if status == "ok" else ans for (status, value), ans in zip(graded, model_answer)]
         
-        # Calculate pass@k metrics
         results = {}
-        for k in [1, 2, 4, 8, 16]:
-            if k <= len(correct):
-                c = sum(correct)
-                if c == 0:
-                    results[f"pass@{k}"] = 0
-                else:
-                    # Handle edge cases to avoid division by zero
-                    if c >= k:
-                        results[f"pass@{k}"] = 1.0
-                    else:
-                        from math import comb
-                        results[f"pass@{k}"] = 1.0 - (comb(len(correct)-c, k) / comb(len(correct), k))
         results['correct'] = correct
+        results['verdicts'] = verdicts
         results['gt_answer'] = gt_answer
         results['answers'] = answers
-        return results, problem_id
-    
+        results['num_samples'] = len(correct)
+        return results
+
+    @staticmethod
+    def grade_passk(passk_args, pool, args, on_problem=None, stop=None):
+        """
+        Grade every sample of every problem in `passk_args` on `pool` (a SupervisedPool of `grade_sample`) and
+        return, per problem, the per-sample (status, value) that `summarize_passk` expects.
+        `on_problem(problem_index, graded)` is called as soon as all samples of a problem are graded.
+        Grading stops early once the `stop` event is set.
+
+        Samples are flattened to one item per distinct (problem, raw answer) and dealt out in small chunks, so
+        idle workers keep taking chunks and a problem with slow sympy answers is spread over several workers.
+        An item that outlives --grade_timeout is marked "timeout" and its worker is replaced.
+        """
+        items, owners = [], []  # owners[i]: the (problem index, sample index) that share items[i]
+        for problem_index, (model_answer, gt_answer, _) in enumerate(passk_args):
+            first = {}
+            for sample_index, ans in enumerate(model_answer):
+                if ans not in first:
+                    first[ans] = len(items)
+                    items.append((ans, gt_answer))
+                    owners.append([])
+                owners[first[ans]].append((problem_index, sample_index))
+        processes = pool.processes
+        chunk_size = args.grade_chunk_size or max(1, min(32, math.ceil(len(items) / (4 * processes))))
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+        graded = [[None] * len(model_answer) for model_answer, _, _ in passk_args]
+        remaining = [len(model_answer) for model_answer, _, _ in passk_args]
+        done_at = []
+        pool.latencies.clear()
+        timeouts, startups = pool.num_timeouts, len(pool.startups)
+        start = time.monotonic()
+        for chunk_index, item_index, status, value in tqdm(
+            pool.run(chunks),
+            total=len(items),
+            desc="Evaluating Pass@K"
+        ):
+            for problem_index, sample_index in owners[chunk_index * chunk_size + item_index]:
+                graded[problem_index][sample_index] = (status, value)
+                remaining[problem_index] -= 1
+                if remaining[problem_index] == 0 and on_problem is not None:
+                    on_problem(problem_index, graded[problem_index])
+            done_at.append(time.monotonic() - start)
+            if stop is not None and stop.is_set():
+                break
+        elapsed = time.monotonic() - start
+
+        # throughput and stragglers
+        n_samples = sum(len(g) for g in graded)
+        latencies = np.array(list(pool.latencies.values()) or [0.0])
+        problem_seconds = np.zeros(len(passk_args))
+        for (chunk_index, item_index), t in pool.latencies.items():
+            problem_seconds[owners[chunk_index * chunk_size + item_index][0][0]] += t
+        tail = elapsed - done_at[int(0.95 * (len(done_at) - 1))] if done_at else 0.0
+        # worker seconds spent starting up during the run; latencies only count from a worker's "ready"
+        startup = sum(ready - max(spawned, start) for spawned, ready in pool.startups[startups:] if ready > start)
+        print(f"Graded {n_samples} samples ({len(items)} distinct answers) in {elapsed:.1f}s: "
+              f"{n_samples / max(elapsed, 1e-9):.1f} samples/s on {processes} workers, chunks of {chunk_size}, "
+              f"workers busy {100 * latencies.sum() / max(processes * elapsed - startup, 1e-9):.0f}% of their up time; "
+              f"{startup:.1f} worker-seconds went to start-up")
+        print(f"Per-answer latency p50 {np.percentile(latencies, 50) * 1e3:.1f}ms, "
+              f"p99 {np.percentile(latencies, 99) * 1e3:.1f}ms, max {latencies.max():.2f}s; "
+              f"the last 5% of answers took {tail:.1f}s")
+        slowest = np.argsort(problem_seconds)[::-1][:5]
+        print("Slowest problems: " + ", ".join(f"{EvalPipeline.problem_label(passk_args[i][2])} ({problem_seconds[i]:.2f}s)"
+                                               for i in slowest))
+        if pool.num_timeouts > timeouts:
+            print(f"{pool.num_timeouts - timeouts} answers timed out after {args.grade_timeout}s and were graded incorrect")
+        return graded
+
     @staticmethod
-    def match_answer_with_contents(gt_answer, model_contents):
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def problem_label(problem_id):
+        """`problem_id`, or "job:problem_id" for the (job, problem_id) pairs of a multi-job run."""
+        return ":".join(map(str, problem_id)) if isinstance(problem_id, tuple) else str(problem_id)
+
+    @staticmethod
+    def puzzle_messages(gt_answer, model_contents):
+        """Judge request asking whether a puzzle sample's final output matches the ground truth."""
         if "</think>" in model_contents:
             model_contents = model_contents.split("</think>")[-1]
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": PUZZLE_EVAL_PROMPT.format(model_output=model_contents, ground_truth=gt_answer)}],
-        )
-        return response.choices[0].message.content.strip().lower() == "true"
+        return [{"role": "user", "content": PUZZLE_EVAL_PROMPT.format(model_output=model_contents, ground_truth=gt_answer)}]
+
+    @staticmethod
+    async def match_answer_with_contents(judge, gt_answer, model_contents):
+        return await judge.ask(EvalPipeline.puzzle_messages(gt_answer, model_contents))
     
     @staticmethod
-    def evaluate_passk_puzzle(args):
+    async def evaluate_passk_puzzle(judge, args):
         model_contents, gt_answer, problem_id = args
-        correct = [EvalPipeline.match_answer_with_contents(gt_answer, ans) for ans in model_contents]
-        # Calculate pass@k metrics
+        correct = list(await asyncio.gather(*(
+            EvalPipeline.match_answer_with_contents(judge, gt_answer, ans) for ans in model_contents
+        )))
         results = {}
-        results["correct"] = correct
-        for k in [1, 2, 4, 8, 16]:
-            if k <= len(correct):
-                c = sum(correct)
-                if c == 0:
-                    results[f"pass@{k}"] = 0
-                else:
-                    # Handle edge cases to avoid division by zero
-                    if c >= k:
-                        results[f"pass@{k}"] = 1.0
-                    else:
-                        from math import comb
-                        results[f"pass@{k}"] = 1.0 - (comb(len(correct)-c, k) / comb(len(correct), k))
         results['correct'] = correct
         results['gt_answer'] = gt_answer
         results['answers'] = model_contents
+        results['num_samples'] = len(correct)
         return results, problem_id
+
+    @staticmethod
+    def judge_requests(passk_args, perception_args, chunk_size=1):
+        """(messages, params) of every judge call `run_judge` will make, for submitting them as a batch up front."""
+        requests = []
+        if passk_args is not None:
+            for model_contents, gt_answer, _ in passk_args:
+                requests += [(EvalPipeline.puzzle_messages(gt_answer, ans), {}) for ans in model_contents]
+        for model_raw, gt_reason, question, _ in perception_args:
+            requests += [(messages, params) for messages, params, _ in
+                         EvalPipeline.perception_requests(model_raw, gt_reason, question, chunk_size)]
+        return requests
+
+    @staticmethod
+    async def run_stages(passk_args, puzzle_passk_args, perception_args, pool, args, on_result):
+        """
+        Grade the sympy pass@k of `passk_args` on `pool`, driven from a worker thread, while the event loop
+        judges puzzle pass@k and perception, so the CPU-bound and the network-bound stage run at the same time
+        instead of one after the other. Finished problems go to `on_result(stage, problem_id, result)` from both,
+        so it must be thread-safe.
+        """
+        def on_problem(problem_index, graded):
+            model_answer, gt_answer, problem_id = passk_args[problem_index]
+            on_result("passk", problem_id, EvalPipeline.summarize_passk(graded, model_answer, gt_answer))
+
+        spans = {}
+
+        async def timed(stage, work):
+            start = time.monotonic()
+            try:
+                return await work
+            finally:
+                spans[stage] = time.monotonic() - start
+
+        stop = threading.Event()
+        stages = [timed("judging", EvalPipeline.run_judge(puzzle_passk_args or None, perception_args, args, on_result))]
+        if passk_args:
+            stages.append(timed("grading", asyncio.to_thread(EvalPipeline.grade_passk, passk_args, pool, args, on_problem, stop)))
+        start = time.monotonic()
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            stop.set()  # on an error or Ctrl-C, do not keep the grading thread (and so the exit) waiting
+        wall = time.monotonic() - start
+        print("Stages: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in spans.items())
+              + f"; {wall:.1f}s in total, {sum(spans.values()) - wall:.1f}s of it overlapped")
+
+    @staticmethod
+    async def run_judge(passk_args, perception_args, args, on_result=None):
+        """
+        Every LLM-judged part of the evaluation on one shared judge client: puzzle pass@k (when `passk_args`
+        is given) and perception. Returns (results_passk or None, results_perception), and hands every
+        problem's result to `on_result(stage, problem_id, result)` as soon as it is judged.
+        """
+        async def reported(stage, evaluation):
+            result, problem_id = await evaluation
+            if on_result is not None:
+                on_result(stage, problem_id, result)
+            return result, problem_id
+
+        judge = Judge(model=args.judge_model, base_url=args.judge_base_url, concurrency=args.judge_concurrency,
+                      rate=args.judge_rps, max_retries=args.judge_max_retries, cache_dir=args.judge_cache_dir,
+                      offline=args.judge_offline)
+        try:
+            if args.judge_batch:
+                # answered batch requests land in the judge cache, where the calls below find them
+                await judge.run_batch(EvalPipeline.judge_requests(passk_args, perception_args, args.perception_chunk_size),
+                                      state_path=args.judge_batch_state, poll_interval=args.judge_batch_poll)
+            chunk_size = args.perception_chunk_size
+            start = time.monotonic()
+            # puzzle pass@k and perception draw on the same judge concurrency at the same time
+            stages = [atqdm.gather(
+                *(reported("perception", EvalPipeline.evaluate_perception(judge, a, chunk_size)) for a in perception_args),
+                desc="Evaluating Perception"
+            )]
+            if passk_args is not None:
+                stages.append(atqdm.gather(
+                    *(reported("passk", EvalPipeline.evaluate_passk_puzzle(judge, a)) for a in passk_args),
+                    desc="Evaluating Pass@K"
+                ))
+            results_perception, *results_passk = await asyncio.gather(*stages)
+            results_passk = results_passk[0] if results_passk else None
+            elapsed = time.monotonic() - start
+        finally:
+            await judge.close()
+        print(f"Judge: {judge.stats['cache_hits']} cached / {judge.stats['deduplicated']} duplicates / "
+              f"{judge.stats['cache_misses']} new ({100 * judge.hit_rate():.1f}% saved), {judge.stats['requests']} API requests, "
+              f"{judge.stats['rate_limited']} rate-limited, {judge.stats['retried']} retried, "
+              f"{judge.stats['prompt_tokens']} prompt tokens"
+              + (f"; {judge.stats.get('batch_answered', 0)}/{judge.stats.get('batch_requests', 0)} answered by batch"
+                 if args.judge_batch else ""))
+        print(f"Judged in {elapsed:.1f}s with {judge.stats['request_seconds'] / max(elapsed, 1e-9):.1f} of "
+              f"{args.judge_concurrency} requests in flight on average")
+        return results_passk, results_perception
+
+    @staticmethod
+    def load_inputs(data_type, model, type_flag, metadata_cache=None, refresh_metadata=False):
+        """
+        (passk_args, perception_args) for every problem of data/{data_type}/{model}/{type_flag}_*.json[l].
+        The dataset's metadata is kept in `metadata_cache`, if given, for the next model; `refresh_metadata`
+        downloads it again instead of reading the local cache.
+        """
+        INFILE = f"data/{data_type}/{model}/{type_flag}_16.json"
+        if Path(INFILE).exists():
+            data = load_results(INFILE)
+        elif Path(INFILE + "l").exists():  # streamed by infer.py --output_format jsonl
+            data = load_results(INFILE + "l")
+        else:
+            base_pattern = re.sub(r"_\d+\.json$", "_*.json", INFILE)
+            # infer.py's checkpoint logs (*.json.ckpt.jsonl) also match *.jsonl, but are not finished results
+            matching_files = sorted(f for f in glob.glob(base_pattern) + glob.glob(base_pattern + "l")
+                                    if not f.endswith(".ckpt.jsonl"))
+            
+            if not matching_files:
+                raise FileNotFoundError(f"No matching files found for pattern: {base_pattern}")
+            
+            INFILE = matching_files[0]  # Pick the first matching file
+            data = load_results(INFILE)
+            
+        metadata_cache = {} if metadata_cache is None else metadata_cache
+        if (data_type, type_flag) not in metadata_cache:
+            columns = [f"{type_flag}_{field}" for field in ("solution", "answer", "question")]
+            metadata_cache[(data_type, type_flag)] = load_metadata_by_key(data_type, columns=columns, refresh=refresh_metadata)
+        metadata = metadata_cache[(data_type, type_flag)]
+        passk_args, perception_args = [], []
+        for problem_id, meta in metadata.items():
+            gt_reason: list[str] = meta[f'{type_flag}_solution']
+            gt_answer: str = meta[f'{type_flag}_answer']
+            if problem_id not in data:
+                continue
+            resp = data[problem_id]
+            model_raw: list[str] = resp["raw"]
+            if "reasoning" in resp and resp["reasoning"][0] != "":
+                model_reasoning: list[str] = resp["reasoning"]
+            else:
+                model_reasoning: list[str] = resp["raw"]
+            model_answer: list[str] = resp["answer"]
+            model_answer = [extract_last_boxed_text(r) if not len(a) else a for r, a in zip(model_reasoning, model_answer)]
+            question: str = meta[f'{type_flag}_question']
+            if data_type == "puzzle":
+                passk_args.append((model_raw, gt_answer, problem_id))
+            else:
+                passk_args.append((model_answer, gt_answer, problem_id))
+            perception_args.append((model_raw, gt_reason, question, problem_id))
+        return passk_args, perception_args
+
+    @staticmethod
+    def add_passk(results_passk, ks):
+        """
+        Fill in pass@k of every problem, computed over the whole result set at once from the per-problem
+        'correct' lists, and return the aggregate {k: mean and bootstrap CI} over problems.
+        """
+        values = passk.pass_at_k([results["correct"] for results, _ in results_passk], ks)
+        for (results, _), row in zip(results_passk, values):
+            results.update(passk.as_dict(row, ks))
+        return passk.aggregate(values, ks)
     
             
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
-    p.add_argument("--data_type", type=str, default="aime", choices=["aime", "math500", "puzzle"])
-    p.add_argument("--model", type=str, choices=list(MODELS.keys()))
-    p.add_argument("--type_flag", type=str, default="modified", choices=["modified", "original"])
+    p.add_argument("--data_type", type=str, nargs="+", default=["aime"], choices=["aime", "math500", "puzzle"])
+    p.add_argument("--model", type=str, nargs="+", required=True, choices=list(MODELS.keys()))
+    p.add_argument("--type_flag", type=str, nargs="+", default=["modified"], choices=["modified", "original"])
+    p.add_argument("--grade_cache_dir", type=str, default=grade_cache.GRADE_CACHE_DIR,
+                   help="on-disk cache of grading verdicts shared across runs and workers; empty to disable")
+    p.add_argument("--grade_timeout", type=float, default=10,
+                   help="seconds a single sample may spend in grading before its worker is killed")
+    p.add_argument("--grade_workers", type=int, default=os.cpu_count(),
+                   help="grading processes")
+    p.add_argument("--grade_chunk_size", type=int, default=0,
+                   help="answers handed to a grading worker at a time; 0 picks one from the number of answers")
+    p.add_argument("--judge_model", type=str, default="gpt-4o-mini")
+    p.add_argument("--judge_base_url", type=str, default=None,
+                   help="OpenAI-compatible endpoint of the judge, e.g. benchmarks/fake_openai_server.py; default $OPENAI_BASE_URL or OpenAI")
+    p.add_argument("--judge_concurrency", type=int, default=64, help="judge requests in flight")
+    p.add_argument("--judge_rps", type=float, default=20, help="judge requests started per second (halved once per 429 burst)")
+    p.add_argument("--judge_max_retries", type=int, default=8)
+    p.add_argument("--judge_cache_dir", type=str, default=JUDGE_CACHE_DIR,
+                   help="on-disk cache of judge replies keyed by the exact request; empty to disable. "
+                        "Must be changed when --judge_base_url is not OpenAI")
+    p.add_argument("--judge_offline", action="store_true",
+                   help="replay judge replies from --judge_cache_dir only and fail on any request not cached")
+    p.add_argument("--judge_batch", action="store_true",
+                   help="send the judge requests through the Batch API first and wait for it; whatever it does not answer is asked live")
+    p.add_argument("--judge_batch_poll", type=float, default=60, help="seconds between batch status checks")
+    p.add_argument("--judge_batch_state", type=str, default=None,
+                   help="where submitted batches are recorded so a restarted run resumes them; "
+                        "default next to the output file (eval/judge.batch.json for several)")
+    p.add_argument("--perception_chunk_size", type=int, default=1,
+                   help="samples judged per perception request (JSON answer with one boolean each); 1 asks per sample. "
+                        "Check agreement first with benchmarks/calibrate_perception.py")
+    p.add_argument("--ks", type=int, nargs="+", default=passk.DEFAULT_KS,
+                   help="k values of pass@k; problems with fewer than k samples get no pass@k")
+    p.add_argument("--refresh_metadata", action="store_true",
+                   help="download the datasets again instead of reading the local cache in cache/metadata")
+    p.add_argument("--relax_sympy_guards", action="store_true",
+                   help="skip the BAD_SUBSTRINGS/BAD_REGEXES blacklist and rely on --grade_timeout instead")
     args = p.parse_args()
-    
-    INFILE = f"data/{args.data_type}/{args.model}/{args.type_flag}_16.json"
-    OUT_FILE = f"eval/{args.data_type}/{args.model}_{args.type_flag}.json"
-
     try:
-        data = json.load(open(INFILE, "r"))
-    except:
-        base_pattern = re.sub(r"_\d+\.json$", "_*.json", INFILE)
-        matching_files = sorted(glob.glob(base_pattern))
-        
-        if not matching_files:
-            raise FileNotFoundError(f"No matching files found for pattern: {base_pattern}")
-        
-        INFILE = matching_files[0]  # Pick the first matching file
-        data = json.load(open(INFILE, "r"))
-        
-    metadata = load_metadata_by_key(args.data_type)
-    if Path(OUT_FILE).exists():
-        print(f"File {OUT_FILE} already exists. Exiting.")
-        exit()
-    else:
-        Path(OUT_FILE).parent.mkdir(parents=True, exist_ok=True)
-        eval_result = {}
+        validate_cache_dir(args.judge_base_url, args.judge_cache_dir)
+    except ValueError as e:
+        p.error(str(e))
+    EvalPipeline.init_grade_worker(args.grade_cache_dir, not args.relax_sympy_guards)
     
-    passk_args, perception_args = [], []
-    for problem_id, meta in metadata.items():
-        gt_reason: list[str] = meta[f'{args.type_flag}_solution']
-        gt_answer: str = meta[f'{args.type_flag}_answer']
-        if problem_id not in data:
-            continue
-        resp = data[problem_id]
-        model_raw: list[str] = resp["raw"]
-        if "reasoning" in resp and resp["reasoning"][0] != "":
-            model_reasoning: list[str] = resp["reasoning"]
-        else:
-            model_reasoning: list[str] = resp["raw"]
-        model_answer: list[str] = resp["answer"]
-        model_answer = [extract_last_boxed_text(r) if not len(a) else a for r, a in zip(model_reasoning, model_answer)]
-        question: str = meta[f'{args.type_flag}_question']
-        # Multiprocessing
-        if args.data_type == "puzzle":
-            passk_args.append((model_raw, gt_answer, problem_id))
-        else:
-            passk_args.append((model_answer, gt_answer, problem_id))
-        perception_args.append((model_raw, gt_reason, question, problem_id))
+    # One job per (data_type, model, type_flag); all of them share the metadata, the grading pool and the judge,
+    # and their problems are graded and judged together.
+    jobs = {}
+    metadata = {}
+    refreshed = set()
+    for data_type in args.data_type:
+        for model in args.model:
+            for type_flag in args.type_flag:
+                OUT_FILE = f"eval/{data_type}/{model}_{type_flag}.json"
+                if Path(OUT_FILE).exists():
+                    print(f"File {OUT_FILE} already exists. Skipping.")
+                    continue
+                try:
+                    # refresh a dataset's metadata once, for the first model that needs it
+                    refresh = args.refresh_metadata and data_type not in refreshed
+                    passk_args, perception_args = EvalPipeline.load_inputs(data_type, model, type_flag, metadata, refresh)
+                    refreshed.add(data_type)
+                except FileNotFoundError as e:
+                    print(f"{e}. Skipping.")
+                    continue
+                Path(OUT_FILE).parent.mkdir(parents=True, exist_ok=True)
+                CKPT_FILE = checkpoint_path(OUT_FILE)
+                # Every finished (problem, stage) is appended to CKPT_FILE; a rerun after a crash skips those.
+                done = load_stage_results(CKPT_FILE)
+                stage_results = {"passk": done.get("passk", {}), "perception": done.get("perception", {})}
+                if done:
+                    print(f"Resuming from checkpoint {CKPT_FILE}: {len(stage_results['passk'])} pass@k and "
+                          f"{len(stage_results['perception'])} perception results done")
+                jobs[f"{data_type}/{model}_{type_flag}"] = {
+                    "out_file": OUT_FILE, "ckpt_file": CKPT_FILE, "data_type": data_type,
+                    "passk_args": passk_args, "perception_args": perception_args, "results": stage_results,
+                }
+    if not jobs:
+        exit()
+    if args.judge_batch_state is None:
+        single = len(jobs) == 1
+        args.judge_batch_state = next(iter(jobs.values()))["out_file"] + ".batch.json" if single else "eval/judge.batch.json"
 
-    
-    with mp.Pool(processes=10) as pool:
-        if args.data_type == "puzzle":
-            results_passk = list(tqdm(
-                pool.imap(EvalPipeline.evaluate_passk_puzzle, passk_args),
-                total=len(passk_args),
-                desc="Evaluating Pass@K"
-            ))
-        else:
-            results_passk = list(tqdm(
-                pool.imap(EvalPipeline.evaluate_passk, passk_args),
-                total=len(passk_args),
-                desc="Evaluating Pass@K"
+    # The unfinished problems of all jobs in one list per stage, problem_id tagged with its job as (job, problem_id).
+    todo = {"passk": [], "puzzle_passk": [], "perception": []}
+    for name, job in jobs.items():
+        passk_stage = "puzzle_passk" if job["data_type"] == "puzzle" else "passk"
+        todo[passk_stage] += [(*a[:-1], (name, a[-1])) for a in job["passk_args"] if a[-1] not in job["results"]["passk"]]
+        todo["perception"] += [(*a[:-1], (name, a[-1])) for a in job["perception_args"]
+                               if a[-1] not in job["results"]["perception"]]
+
+    lock = threading.Lock()  # grading reports from its thread, judging from the event loop
+    with contextlib.ExitStack() as stack:
+        fckpts = {name: stack.enter_context(open(job["ckpt_file"], "a", encoding="utf-8")) for name, job in jobs.items()}
+
+        def on_result(stage, tagged_id, result):
+            name, problem_id = tagged_id
+            with lock:
+                jobs[name]["results"][stage][problem_id] = result
+                append_record(fckpts[name], problem_id, {"stage": stage, "result": result})
+
+        pool = None
+        if todo["passk"]:
+            # Grading runs next to the event loop's threads, so workers (and the replacements of timed-out ones)
+            # come from a forkserver instead of forking this process. Each of them re-runs this script on start-up;
+            # preloading it under its module name puts sympy, openai etc. in the forkserver once, so that is cheap.
+            pool = stack.enter_context(SupervisedPool(
+                EvalPipeline.grade_sample, processes=args.grade_workers, timeout=args.grade_timeout,
+                initializer=EvalPipeline.init_grade_worker, initargs=(args.grade_cache_dir, not args.relax_sympy_guards),
+                start_method="forkserver", preload=["eval_pipeline"],
             ))
-    EvalPipeline.evaluate_perception(perception_args[0])
-    with mp.Pool(processes=10) as pool:
-        results_perception = list(tqdm(
-            pool.imap(EvalPipeline.evaluate_perception, perception_args),
-            total=len(perception_args),
-            desc="Evaluating Perception"
-        ))
-    
-    perception_results, problem_ids_perception = zip(*results_perception)
-    passk_results, problem_ids_passk = zip(*results_passk)
-        
-    for problem_id, passk in zip(problem_ids_passk, passk_results):
-        eval_result[problem_id] = {
-            "perception": perception_results[problem_ids_perception.index(problem_id)],
-            "passk": passk
+        asyncio.run(EvalPipeline.run_stages(todo["passk"], todo["puzzle_passk"], todo["perception"], pool, args, on_result))
+
+    for name, job in jobs.items():
+        stage_results = job["results"]
+        results_passk = [(stage_results["passk"][problem_id], problem_id) for _, _, problem_id in job["passk_args"]]
+        for k, summary in EvalPipeline.add_passk(results_passk, args.ks).items():
+            print(f"{name} pass@{k}: {summary['mean']:.4f} (95% CI {summary['ci_low']:.4f}-{summary['ci_high']:.4f}, "
+                  f"{summary['n_problems']} problems)")
+
+        eval_result = {
+            problem_id: {"perception": stage_results["perception"][problem_id], "passk": results}
+            for results, problem_id in results_passk
         }
-    with open(OUT_FILE, "w") as f:
-        json.dump(eval_result, f, indent=4)
\ No newline at end of file
+        tmp_file = job["out_file"] + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(eval_result, f, indent=4)
+        os.replace(tmp_file, job["out_file"])
+        Path(job["ckpt_file"]).unlink()
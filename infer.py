@@ -1,25 +1,34 @@
 import os
 import json
-import torch
+import math
+import time
 import dotenv
 import argparse
+import contextlib
 from pathlib import Path
-from collections import defaultdict
-from vllm import LLM, SamplingParams
-from transformers import AutoTokenizer
+import multiprocessing as mp
+from collections import deque
 from models import MODELS
 from rich.panel import Panel
 from rich.console import Console
+from rich.table import Table
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeElapsedColumn
 from utils.extract import extract_last_boxed_text, extract_tag_contents
-from utils.prompt import build_prompt
+from utils.grade_cache import grade_completion
+from utils.prompt import cached_build_prompts
 from utils.load_metadata import load_metadata_by_key
+from utils.results_io import checkpoint_path, partial_path, load_checkpoint, load_problem_ids, append_record
+from utils.worker_pool import SupervisedPool
 
 dotenv.load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
 console = Console()
 
 def get_model(args):
+    # vLLM (and torch) are imported here rather than at module level: grading workers re-run this script on start-up
+    # and must not pay for them.
+    from vllm import LLM, SamplingParams
+
     model_id = MODELS[args.model][0] 
     max_len = MODELS[args.model][1]
     temperature = MODELS[args.model][2]
@@ -28,7 +37,8 @@ def get_model(args):
     repetition_penalty = MODELS[args.model][5]
     
     with console.status(f"[bold green]Loading model {args.model}...") as status:
-        llm = LLM(model_id, tensor_parallel_size=args.tensor_parallel_size, max_model_len=max_len)
+        llm = LLM(model_id, tensor_parallel_size=args.tensor_parallel_size, max_model_len=max_len,
+                  enable_prefix_caching=True)
         # Set sampling parameters
         sampling_params = SamplingParams(
             n = args.num_samples,
@@ -39,107 +49,321 @@ def get_model(args):
             top_k=top_k,
             repetition_penalty=repetition_penalty
             )
-        tokenizer = AutoTokenizer.from_pretrained(MODELS[args.model][0])
-        tokenizer.padding_side = 'left'  # Set padding to left for decoder-only models
+        tokenizer = llm.get_tokenizer()  # reuse vLLM's tokenizer instead of loading a second copy
     return llm, sampling_params, tokenizer
 
 
+def extract_outputs(texts, enable_thinking):
+    """Pull the boxed answer (and <think> block) out of every completion; runs in a worker process."""
+    start = time.perf_counter()
+    answers, reasonings = [], []
+    for raw in texts:
+        try:
+            answer = extract_last_boxed_text(raw).strip().lower()
+        except Exception:
+            answer = raw
+        try:
+            reasoning = extract_tag_contents(raw)["think"] if enable_thinking else ""
+        except Exception:
+            reasoning = ""
+        answers.append(answer)
+        reasonings.append(reasoning)
+    return answers, reasonings, time.perf_counter() - start
+
+
+def build_record(texts, prompt, gt_answer, extracted, args) -> dict:
+    answers, reasonings, _ = extracted
+    record = {"raw": list(texts), "prompt": prompt, "answer": answers, "reasoning": reasonings, "gt_answer": gt_answer}
+    if args.adaptive:
+        record["num_samples"] = len(texts)
+    return record
+
+
+def pass1_decided(correct, args) -> bool:
+    """
+    True once the Wilson score interval on pass@1 over `correct` is narrower than
+    ±args.adaptive_tol (after at least args.adaptive_min_samples), or the budget is spent.
+    """
+    n = len(correct)
+    if n >= args.num_samples:
+        return True
+    if n < args.adaptive_min_samples:
+        return False
+    z = args.adaptive_z
+    p_hat = sum(correct) / n
+    half_width = z * math.sqrt(p_hat * (1 - p_hat) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return half_width <= args.adaptive_tol
+
+
+def sample_adaptive(llm, sampling_params, chunk, chunk_inputs, metadata, grade_pool, args):
+    """
+    Draw completions in rounds of args.round_size, grading each round on `grade_pool`,
+    and stop asking for more samples for a problem as soon as its pass@1 is decided.
+    A completion whose grading outlives --grade_timeout (or fails) counts as incorrect.
+    """
+    texts = [[] for _ in chunk]
+    correct = [[] for _ in chunk]
+    active = list(range(len(chunk)))
+    responses = []
+    while active:
+        round_params = sampling_params.clone()
+        round_params.n = min(args.round_size, args.num_samples - len(texts[active[0]]))
+        response = llm.generate([chunk_inputs[i] for i in active], sampling_params=round_params, use_tqdm=False)
+        responses += response
+        tasks = []
+        for i, resp in zip(active, response):
+            (data_type, type_flag), pid = chunk[i]
+            gt_answer = metadata[data_type][pid][f"{type_flag}_answer"]
+            new_texts = [o.text for o in resp.outputs]
+            texts[i] += new_texts
+            tasks.append([(text, gt_answer) for text in new_texts])
+        verdicts = [[False] * len(task) for task in tasks]
+        for task_index, item_index, status, value in grade_pool.run(tasks):
+            verdicts[task_index][item_index] = status == "ok" and bool(value)
+        for i, task_verdicts in zip(active, verdicts):
+            correct[i] += task_verdicts
+        active = [i for i in active if not pass1_decided(correct[i], args)]
+    return texts, responses
+
+
+def output_path(args, data_type, type_flag) -> str:
+    outfile = f"data/{data_type}/{args.model.lower().replace('-', '_')}/"
+    if args.cot:
+        outfile += f"{type_flag}_{args.num_samples}.json"
+    else:
+        outfile += f"{type_flag}_nocot_{args.num_samples}.json"
+    if args.output_format == "jsonl":
+        outfile += "l"
+    return outfile
+
+
+def prefix_sort_key(prompt) -> str:
+    return prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False)
+
+
+def generate_records(llm, sampling_params, pending, prompts, engine_inputs, jobs, metadata, pool, args,
+                     grade_pool=None) -> None:
+    """
+    Generate `engine_inputs` (the rendered `prompts`, or their token ids) and hand every finished problem
+    to its job's checkpoint log and/or results.
+    Answer extraction runs in a process pool, overlapping with the generation of the next chunk;
+    --adaptive rounds are graded on `grade_pool`.
+    """
+    stream = args.output_format == "jsonl"
+    # Never set on the command line, so reasoning stays "" and eval_pipeline falls back to "raw", as before.
+    enable_thinking = getattr(args, "enable_thinking", False)
+    # Without --resume everything goes to vLLM as one batch, as before.
+    chunk_size = args.chunk_size if args.resume else max(len(prompts), 1)
+    timings = {"generate": 0.0, "extract (worker)": 0.0, "extract (wait)": 0.0, "write": 0.0}
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+        TimeElapsedColumn(),
+        console=console
+    ) as progress:
+        fckpts = {key: open(job["ckpt_file"], "a", encoding="utf-8") for key, job in jobs.items()} if args.resume or stream else {}
+        in_flight = deque()  # (key, pid, prompt, texts, AsyncResult) in submission order
+        prompt_tokens, cached_tokens = 0, 0
+
+        def write_finished(block):
+            while in_flight and (block or in_flight[0][-1].ready()):
+                key, pid, prompt, texts, async_result = in_flight.popleft()
+                start = time.perf_counter()
+                extracted = async_result.get()
+                timings["extract (wait)"] += time.perf_counter() - start
+                timings["extract (worker)"] += extracted[-1]
+
+                start = time.perf_counter()
+                data_type, type_flag = key
+                gt_answer = str(metadata[data_type][pid][f"{type_flag}_answer"]).strip().lower()
+                record = build_record(texts, prompt, gt_answer, extracted, args)
+                if key in fckpts:
+                    append_record(fckpts[key], pid, record)
+                if not stream:
+                    jobs[key]["results"][pid] = record
+                timings["write"] += time.perf_counter() - start
+                progress.update(process_task, advance=1)
+
+        try:
+            task = progress.add_task("[cyan]Generating responses...", total=len(prompts))
+            process_task = progress.add_task("[cyan]Processing responses...", total=len(prompts))
+            for start in range(0, len(prompts), chunk_size):
+                chunk = pending[start:start + chunk_size]
+                chunk_prompts = prompts[start:start + chunk_size]
+                chunk_inputs = engine_inputs[start:start + chunk_size]
+                gen_start = time.perf_counter()
+                if args.adaptive:
+                    chunk_texts, response = sample_adaptive(llm, sampling_params, chunk, chunk_inputs, metadata, grade_pool, args)
+                else:
+                    response = llm.generate(chunk_inputs, sampling_params=sampling_params)
+                    chunk_texts = [[o.text for o in resp.outputs] for resp in response]
+                timings["generate"] += time.perf_counter() - gen_start
+                for resp in response:
+                    prompt_tokens += len(resp.prompt_token_ids or [])
+                    cached_tokens += getattr(resp, "num_cached_tokens", None) or 0
+                for (key, pid), prompt, texts in zip(chunk, chunk_prompts, chunk_texts):
+                    in_flight.append((key, pid, prompt, texts, pool.apply_async(extract_outputs, (texts, enable_thinking))))
+                progress.update(task, advance=len(chunk_prompts))
+                write_finished(block=False)
+            write_finished(block=True)
+        except BaseException as e:
+            # Keep what was already generated: write its problems before the logs close. On Ctrl-C the
+            # extraction workers are interrupted too, so only the results that are ready can be waited for.
+            write_finished(block=not isinstance(e, KeyboardInterrupt))
+            raise
+        finally:
+            for fckpt in fckpts.values():
+                fckpt.close()
+    if prompt_tokens:
+        console.print(f"[bold blue]Prefix cache:[/] {cached_tokens}/{prompt_tokens} prompt tokens reused "
+                      f"({100 * cached_tokens / prompt_tokens:.1f}% hit rate)")
+    table = Table(title="Stage timings")
+    table.add_column("Stage")
+    table.add_column("Seconds", justify="right")
+    for stage, seconds in timings.items():
+        table.add_row(stage, f"{seconds:.2f}")
+    console.print(table)
+
+
 def main() -> None:
     p = argparse.ArgumentParser()
     p.add_argument("--model", type=str, choices=list(MODELS.keys()))
     p.add_argument("--num_samples", type=int, default=16,
                    help="number of completions per prompt")
     p.add_argument("--tensor_parallel_size", type=int, default=2)
-    p.add_argument("--data_type", type=str, required=True, choices=["aime", "math500", "puzzle"])
+    p.add_argument("--data_type", type=str, nargs="+", required=True, choices=["aime", "math500", "puzzle"])
     p.add_argument("--debug", action="store_true")
-    p.add_argument("--type_flag", type=str, required=True, choices=["original", "modified"])
+    p.add_argument("--type_flag", type=str, nargs="+", required=True, choices=["original", "modified"])
     p.add_argument("--cot", action="store_true")
+    p.add_argument("--resume", action="store_true",
+                   help="generate in chunks, append finished problems to OUTFILE.ckpt.jsonl and skip them on restart")
+    p.add_argument("--chunk_size", type=int, default=32,
+                   help="problems per llm.generate call when --resume is set")
+    p.add_argument("--output_format", type=str, default="json", choices=["json", "jsonl"],
+                   help="jsonl streams one record per problem to OUTFILE.partial as soon as it is processed "
+                        "and renames it to OUTFILE when done")
+    p.add_argument("--prompt_cache_dir", type=str, default="cache/prompts",
+                   help="where rendered prompts are cached per (model, data_type, type_flag, cot); empty to disable")
+    p.add_argument("--cache_token_ids", action="store_true",
+                   help="also cache prompt token ids and pass them to vLLM, skipping tokenization")
+    p.add_argument("--num_workers", type=int, default=min(8, os.cpu_count() or 1),
+                   help="processes used to extract answers from completions")
+    p.add_argument("--adaptive", action="store_true",
+                   help="sample in rounds and stop early once pass@1 is decided; --num_samples becomes the cap")
+    p.add_argument("--round_size", type=int, default=4,
+                   help="completions drawn per problem in each adaptive round")
+    p.add_argument("--adaptive_min_samples", type=int, default=8,
+                   help="never stop a problem before it has this many samples")
+    p.add_argument("--adaptive_tol", type=float, default=0.2,
+                   help="stop once the pass@1 confidence interval half-width is at most this")
+    p.add_argument("--adaptive_z", type=float, default=1.96,
+                   help="z-score of the Wilson interval used by --adaptive (1.96 = 95%%)")
+    p.add_argument("--refresh_metadata", action="store_true",
+                   help="download the datasets again instead of reading the local cache in cache/metadata")
+    p.add_argument("--grade_timeout", type=float, default=10,
+                   help="seconds --adaptive may spend grading one completion before it counts as incorrect")
     args = p.parse_args()
+    if args.adaptive and "puzzle" in args.data_type:
+        p.error("--adaptive grades with grade_answer_sympy and does not support --data_type puzzle")
+    stream = args.output_format == "jsonl"
 
     console.print(Panel.fit(
         f"[bold blue]Model:[/] {args.model}\n"
-        f"[bold blue]Dataset:[/] {args.data_type}\n"
+        f"[bold blue]Dataset:[/] {', '.join(args.data_type)}\n"
         f"[bold blue]Samples:[/] {args.num_samples}\n"
-        f"[bold blue]Type:[/] {args.type_flag}",
+        f"[bold blue]Type:[/] {', '.join(args.type_flag)}",
         title="[bold green]Configuration"
     ))
 
-    metadata = load_metadata_by_key(args.data_type)
-        
-    OUTFILE = f"data/{args.data_type}/{args.model.lower().replace('-', '_')}/"
-    if args.cot:
-        OUTFILE += f"{args.type_flag}_{args.num_samples}.json"
-    else:
-        OUTFILE += f"{args.type_flag}_nocot_{args.num_samples}.json"
-    if Path(OUTFILE).exists():
+    # One job per (data_type, type_flag); all of them share a single model load and generate batch.
+    jobs = {}
+    metadata = {}
+    for data_type in args.data_type:
+        for type_flag in args.type_flag:
+            OUTFILE = output_path(args, data_type, type_flag)
+            if Path(OUTFILE).exists():
+                console.print(f"[bold yellow]Skipping existing output file:[/] {OUTFILE}")
+                continue
+            if data_type not in metadata:
+                columns = [f"{t}_{field}" for t in args.type_flag for field in ("question", "answer")]
+                metadata[data_type] = load_metadata_by_key(data_type, columns=columns, refresh=args.refresh_metadata)
+            Path(OUTFILE).parent.mkdir(parents=True, exist_ok=True)
+            console.print(f"[bold yellow]Output file:[/] {OUTFILE}")
+
+            if stream:
+                # Streamed to OUTFILE.partial, its own checkpoint log, and renamed to OUTFILE once complete,
+                # so a crashed run never leaves an OUTFILE that looks finished.
+                CKPT_FILE = partial_path(OUTFILE)
+                results = {}
+                if not args.resume:
+                    Path(CKPT_FILE).unlink(missing_ok=True)
+                done = load_problem_ids(CKPT_FILE) if args.resume else set()
+            else:
+                CKPT_FILE = checkpoint_path(OUTFILE)
+                results = load_checkpoint(CKPT_FILE) if args.resume else {}
+                done = set(results)
+            if done:
+                console.print(f"[bold yellow]Resuming from checkpoint:[/] {CKPT_FILE} ({len(done)} problems done)")
+            jobs[(data_type, type_flag)] = {"outfile": OUTFILE, "ckpt_file": CKPT_FILE, "results": results, "done": done}
+    if not jobs:
         return
-    else:
-        results = {}
-    Path(OUTFILE).parent.mkdir(parents=True, exist_ok=True)
-    console.print(f"[bold yellow]Output file:[/] {OUTFILE}")
-    
-    problem_ids = list(metadata.keys())
-    llm, sampling_params, tokenizer = get_model(args)
 
-    prompts = [build_prompt(prompt=metadata[pid][f'{args.type_flag}_question'], tokenizer=tokenizer, args=args) for pid in problem_ids if pid not in results]
-    
-    if args.debug:
-        prompts = prompts[:2]
-    
-    console.print(f"[bold green]Processing {len(prompts)} prompts → {args.num_samples} completions each[/]")
+    pending = []  # (job key, problem_id)
+    for (data_type, type_flag), job in jobs.items():
+        problem_ids = [pid for pid in metadata[data_type].keys() if pid not in job["done"]]
+        if args.debug:
+            problem_ids = problem_ids[:2]
+        pending += [((data_type, type_flag), pid) for pid in problem_ids]
+    if pending:
+        # Fork the extraction workers before vLLM starts its threads and initialises CUDA. Adaptive grading needs
+        # to replace workers stuck on an answer later on, so its workers come from a forkserver instead.
+        grading = contextlib.nullcontext()
+        if args.adaptive:
+            grading = SupervisedPool(grade_completion, processes=max(args.num_workers, 1), timeout=args.grade_timeout,
+                                     start_method="forkserver", preload=["utils.grade_cache"])
+        with mp.Pool(processes=max(args.num_workers, 1)) as pool, grading as grade_pool:
+            llm, sampling_params, tokenizer = get_model(args)
 
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        BarColumn(),
-        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-        TimeElapsedColumn(),
-        console=console
-    ) as progress:
-        task = progress.add_task("[cyan]Generating responses...", total=len(prompts))
-        response = llm.generate(prompts, sampling_params=sampling_params)
-        progress.update(task, completed=len(prompts))
-    
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        BarColumn(),
-        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-        TimeElapsedColumn(),
-        console=console
-    ) as progress:
-        task = progress.add_task("[cyan]Processing responses...", total=len(response))
-        print(len(response[0].outputs))
-        with open(OUTFILE, "w", encoding="utf-8") as fout:
-            for idx, resp in enumerate(response):
-                if problem_ids[idx] not in results:
-                    results[problem_ids[idx]] = defaultdict(list)
-                
-                for r in resp.outputs:
-                    raw = r.text
-                    try:
-                        answer = extract_last_boxed_text(raw).strip().lower()
-                    except:
-                        answer = raw
-                    try:
-                        reasoning = extract_tag_contents(raw)["think"] if args.enable_thinking else ""
-                    except:
-                        reasoning = ""
-                    gt_answer = str(metadata[problem_ids[idx]][f"{args.type_flag}_answer"]).strip().lower()
-                    results[problem_ids[idx]]["raw"].append(raw)
-                    results[problem_ids[idx]]["prompt"] = prompts[idx]
-                    results[problem_ids[idx]]["answer"].append(answer)
-                    results[problem_ids[idx]]["reasoning"].append(reasoning)
-                    results[problem_ids[idx]]["gt_answer"] = gt_answer
-                progress.update(task, advance=1)
-
-    with open(OUTFILE, "w") as fout:
-        json.dump(results, fout, indent=4)
-        
-    console.print(Panel.fit(
-        f"[bold green]Successfully generated output file:[/]\n{OUTFILE}",
-        title="[bold green]Complete"
-    ))
+            rendered, token_ids = {}, {}
+            for key in jobs:
+                data_type, type_flag = key
+                questions = {pid: meta[f'{type_flag}_question'] for pid, meta in metadata[data_type].items()}
+                cache_file = None
+                if args.prompt_cache_dir:
+                    cache_file = f"{args.prompt_cache_dir}/{args.model}/{data_type}_{type_flag}_{'cot' if args.cot else 'nocot'}.json"
+                rendered[key], token_ids[key] = cached_build_prompts(
+                    questions, args, tokenizer, cache_file=cache_file, with_token_ids=args.cache_token_ids)
+            prompts = [rendered[key][pid] for key, pid in pending]
+            # Every prompt starts with the same chat template and header, and original/modified variants of a problem
+            # share its text; sorting puts shared prefixes next to each other so the prefix cache skips their prefill.
+            order = sorted(range(len(prompts)), key=lambda i: prefix_sort_key(prompts[i]))
+            pending = [pending[i] for i in order]
+            prompts = [prompts[i] for i in order]
+            engine_inputs = [
+                {"prompt_token_ids": token_ids[key][pid]} if token_ids[key] is not None else prompt
+                for (key, pid), prompt in zip(pending, prompts)
+            ]
+
+            console.print(f"[bold green]Processing {len(prompts)} prompts → {args.num_samples} completions each[/]")
+            generate_records(llm, sampling_params, pending, prompts, engine_inputs, jobs, metadata, pool, args, grade_pool)
+
+    for (data_type, type_flag), job in jobs.items():
+        if stream:
+            Path(job["ckpt_file"]).touch()  # a job with no problems to generate never opened it
+            os.replace(job["ckpt_file"], job["outfile"])
+        else:
+            results = {pid: job["results"][pid] for pid in metadata[data_type].keys() if pid in job["results"]}
+            with open(job["outfile"], "w") as fout:
+                json.dump(results, fout, indent=4)
+            if args.resume:
+                Path(job["ckpt_file"]).unlink(missing_ok=True)
+
+        console.print(Panel.fit(
+            f"[bold green]Successfully generated output file:[/]\n{job['outfile']}",
+            title="[bold green]Complete"
+        ))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
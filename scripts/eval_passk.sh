@@ -3,10 +3,6 @@
 # Import models from all_models
 source scripts/all_models.sh
 
-for TYPE_FLAG in "modified"; do
-    for DATA in "math500" "aime"; do
-        for MODEL in "${MODELS[@]}"; do
-            python3 eval_pipeline.py --data "$DATA" --model "$MODEL" --type_flag "$TYPE_FLAG"
-        done
-    done
-done
\ No newline at end of file
+# One process for every model and dataset: the metadata, grading pool and judge client are shared,
+# and outputs that already exist are skipped.
+python3 eval_pipeline.py --data_type "math500" "aime" --model "${MODELS[@]}" --type_flag "modified"
@@ -0,0 +1,100 @@
+"""
+Memoized `grade_answer_sympy`.
+
+The same boxed answer shows up many times among the samples of a problem, and the same answer strings recur
+across models and reruns. Verdicts are keyed by (normalized given answer, ground truth), which is all
+`grade_answer_sympy` looks at, and kept in an in-process LRU backed by an on-disk cache that pool workers share.
+"""
+import os
+import json
+from collections import OrderedDict
+from utils import math_utils
+from utils.extract import extract_last_boxed_text
+from utils.math_utils import _normalize, grade_answer_sympy
+
+GRADE_CACHE_DIR = os.getenv("REASONINGTRAP_GRADE_CACHE", "cache/grades")
+LRU_SIZE = 1 << 16
+
+
+class _LRU(OrderedDict):
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def lookup(self, key):
+        value = self.get(key)
+        if value is not None:
+            self.move_to_end(key)
+        return value
+
+    def store(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+_lru = _LRU(LRU_SIZE)
+_disk = None
+_disk_pid = None
+
+
+def _disk_cache():
+    """Open the on-disk cache lazily, once per process, so forked pool workers get their own handle."""
+    global _disk, _disk_pid
+    if not GRADE_CACHE_DIR:
+        return None
+    if _disk is None or _disk_pid != os.getpid():
+        import diskcache
+        _disk = diskcache.Cache(GRADE_CACHE_DIR)
+        _disk_pid = os.getpid()
+    return _disk
+
+
+def _lookup(key):
+    value = _lru.lookup(key)
+    if value is not None:
+        return value
+    disk = _disk_cache()
+    value = disk.get(key) if disk is not None else None
+    if value is not None:
+        _lru.store(key, value)
+    return value
+
+
+def _store(key, value):
+    disk = _disk_cache()
+    if disk is not None:
+        disk.set(key, value)
+    _lru.store(key, value)
+
+
+def _cached(key, compute):
+    value = _lookup(key)
+    if value is None:
+        value = compute()
+        _store(key, value)
+    return value
+
+
+def normalize_cached(expr: str) -> str:
+    return _cached(("normalize", expr), lambda: _normalize(expr))
+
+
+def grade_answer_cached(given_answer: str, ground_truth: str | list):
+    """Drop-in replacement for `grade_answer_sympy` that returns the memoized (is_correct, gt_normalized, given_normalized)."""
+    gt_key = json.dumps(ground_truth, ensure_ascii=False)
+    # The "infinitely many" ground truths are checked against the raw answer, so they are not keyed by its normal form.
+    if not isinstance(given_answer, str) or "infinitely" in gt_key.lower():
+        return grade_answer_sympy(given_answer, ground_truth)
+    return _cached(_verdict_key(given_answer, gt_key), lambda: grade_answer_sympy(given_answer, ground_truth))
+
+
+def grade_completion(item):
+    """Whether one completion's boxed answer is correct; the SupervisedPool worker function for adaptive sampling."""
+    text, gt_answer = item
+    return grade_answer_cached(extract_last_boxed_text(text).strip().lower(), gt_answer)[0]
+
+
+def _verdict_key(given_answer, gt_key):
+    return ("verdict", math_utils.SYMPY_GUARDS, normalize_cached(given_answer), gt_key)
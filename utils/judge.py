@@ -0,0 +1,322 @@
+"""
+Asynchronous LLM judge.
+
+All requests go through one AsyncOpenAI client, so connections (and their TLS sessions) are reused. At most
+`concurrency` requests are in flight, and a token bucket paces how fast new ones start. A 429 pauses the
+bucket for its Retry-After and halves the rate, which then creeps back up with every success. Other transient
+failures are retried with jittered exponential backoff. The client's own retries are disabled so that
+every retry goes through the bucket.
+
+Replies are cached on disk under the sha256 of the exact request (model, messages and any other parameters),
+so an unchanged rerun makes no API calls, and a request identical to one already in flight waits for that
+one's reply instead of being sent again; with `offline=True` a request missing from the cache is an error
+instead of an API call. Requests to any endpoint other than OpenAI's are keyed by that endpoint too and may not
+use the default cache directory, so their replies never stand in for OpenAI's.
+`run_batch` fills the cache through the Batch API instead of live calls, after which the same requests are answered
+from the cache.
+"""
+import os
+import json
+import time
+import hashlib
+import random
+import asyncio
+from pathlib import Path
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+RETRYABLE = (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+JUDGE_CACHE_DIR = os.getenv("REASONINGTRAP_JUDGE_CACHE", "cache/judge")
+OPENAI_ENDPOINT = "https://api.openai.com/v1"
+
+
+class JudgeCacheMiss(KeyError):
+    """Raised in offline mode for a request that has no cached reply."""
+
+
+def request_key(model: str, messages: list, **kwargs) -> str:
+    """Content address of a judge request: sha256 of its canonical JSON."""
+    request = {"model": model, "messages": messages, **kwargs}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def validate_cache_dir(base_url, cache_dir) -> str:
+    """
+    The endpoint `base_url` resolves to; raises ValueError if it is not OpenAI's but `cache_dir` is the default,
+    which holds OpenAI's replies.
+    """
+    endpoint = (base_url or os.getenv("OPENAI_BASE_URL") or OPENAI_ENDPOINT).rstrip("/")
+    if endpoint != OPENAI_ENDPOINT and cache_dir == JUDGE_CACHE_DIR:
+        raise ValueError(f"judging with {endpoint} needs its own judge cache dir (or none) instead of the default "
+                         f"{JUDGE_CACHE_DIR}, which holds OpenAI's replies")
+    return endpoint
+
+
+class TokenBucket:
+    """Lets through `rate` acquisitions per second on average, in bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self, retry_after: float):
+        """
+        The server said 429: stop everyone for `retry_after` seconds and halve the rate. The 429s of the
+        requests already in flight belong to the same event, so they extend the pause without halving again.
+        """
+        now = time.monotonic()
+        if now >= self.paused_until:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+        self.paused_until = max(self.paused_until, now + retry_after)
+        self.tokens = 0
+
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate * 1.05)
+
+
+def retry_after_seconds(response: httpx.Response):
+    """Seconds to wait according to the Retry-After(-Ms) headers of a 429, or None."""
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # an HTTP date; fall back to backoff
+    return None
+
+
+class Judge:
+    """
+    Usage:
+        judge = Judge(model="gpt-4o-mini", concurrency=64, rate=20)
+        verdicts = await asyncio.gather(*(judge.ask(messages) for messages in requests))
+        await judge.close()
+    """
+
+    def __init__(self, model="gpt-4o-mini", base_url=None, api_key=None, concurrency=64, rate=20.0,
+                 max_retries=8, backoff=1.0, max_backoff=60.0, timeout=120.0, cache_dir=JUDGE_CACHE_DIR, offline=False):
+        self.model = model
+        self.offline = offline
+        if not cache_dir and offline:
+            raise ValueError("offline judging replays the cache, so it needs a cache_dir")
+        self.endpoint = validate_cache_dir(base_url, cache_dir)
+        base_url = base_url or os.getenv("OPENAI_BASE_URL") or None
+        self.cache = None
+        if cache_dir:
+            import diskcache
+            self.cache = diskcache.Cache(cache_dir)
+        self.client = AsyncOpenAI(
+            # offline runs never reach the API, so they need no key
+            api_key=api_key or os.getenv("OPENAI_API_KEY") or ("offline" if offline else None),
+            base_url=base_url,
+            max_retries=0,
+            timeout=timeout,
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.in_flight = {}  # request key -> future of its reply
+        self.stats = {"cache_hits": 0, "deduplicated": 0, "cache_misses": 0, "requests": 0, "rate_limited": 0,
+                      "retried": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0, "request_seconds": 0.0}
+
+    async def complete(self, messages: list, **kwargs) -> str:
+        """
+        Content of the judge's reply to `messages`: from the cache if this exact request was made before, shared
+        with an identical request that is still in flight, or else from the API.
+        """
+        key = self._key(messages, kwargs)
+        if self.cache is not None:
+            content = self.cache.get(key)
+            if content is not None:
+                self.stats["cache_hits"] += 1
+                return content
+        if key in self.in_flight:
+            self.stats["deduplicated"] += 1
+            return await asyncio.shield(self.in_flight[key])
+        self.stats["cache_misses"] += 1
+        if self.offline:
+            raise JudgeCacheMiss(f"offline judge has no cached reply for request {key}")
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            content = await self._request(messages, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here, so no "never retrieved" warning when nobody was waiting
+            raise
+        finally:
+            del self.in_flight[key]
+        if self.cache is not None:
+            self.cache.set(key, content)
+        future.set_result(content)
+        return content
+
+    def _key(self, messages, params) -> str:
+        # a reply from another endpoint (a local model, the fake server) must never answer an OpenAI request
+        endpoint = {} if self.endpoint == OPENAI_ENDPOINT else {"endpoint": self.endpoint}
+        return request_key(self.model, messages, **endpoint, **params)
+
+    async def _request(self, messages: list, **kwargs) -> str:
+        """One API call, retrying 429s and transient errors."""
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.bucket.acquire()
+                self.stats["requests"] += 1
+                start = time.monotonic()
+                try:
+                    response = await self.client.chat.completions.create(model=self.model, messages=messages, **kwargs)
+                    self.bucket.recover()
+                    self._count_usage(response.usage)
+                    return response.choices[0].message.content
+                except openai.RateLimitError as e:
+                    self.stats["rate_limited"] += 1
+                    error, wait = e, retry_after_seconds(e.response)
+                    self.bucket.throttle(wait if wait is not None else self._backoff(attempt))
+                    wait = 0  # the bucket holds every request back until then
+                except RETRYABLE as e:
+                    error, wait = e, self._backoff(attempt)
+                finally:
+                    self.stats["request_seconds"] += time.monotonic() - start
+                if attempt < self.max_retries:
+                    self.stats["retried"] += 1
+                    await asyncio.sleep(wait)
+            self.stats["failed"] += 1
+            raise error
+
+    def _backoff(self, attempt):
+        # "full jitter": spread retries out so they do not arrive together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def ask(self, messages: list) -> bool:
+        """True iff the judge answers "true"."""
+        return (await self.complete(messages)).strip().lower() == "true"
+
+    async def ask_json(self, messages: list, response_format: dict):
+        """The judge's reply parsed as JSON (request it with a json_schema `response_format`), or None if it is not."""
+        content = await self.complete(messages, response_format=response_format)
+        try:
+            return json.loads(content)
+        except (TypeError, ValueError):
+            return None
+
+    def _count_usage(self, usage):
+        if usage is not None:
+            self.stats["prompt_tokens"] += getattr(usage, "prompt_tokens", None) or 0
+            self.stats["completion_tokens"] += getattr(usage, "completion_tokens", None) or 0
+
+    def _batch_line(self, key, messages, params) -> dict:
+        return {"custom_id": key, "method": "POST", "url": "/v1/chat/completions",
+                "body": {"model": self.model, "messages": messages, **params}}
+
+    async def _submit_batch(self, lines) -> dict:
+        data = "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode()
+        file = await self.client.files.create(file=("judge_requests.jsonl", data), purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=file.id, endpoint="/v1/chat/completions", completion_window="24h"
+        )
+        self.stats["batch_requests"] = self.stats.get("batch_requests", 0) + len(lines)
+        return {"batch_id": batch.id, "input_file_id": file.id, "num_requests": len(lines),
+                "keys": [line["custom_id"] for line in lines]}
+
+    async def _collect_batch(self, batch_id, poll_interval) -> int:
+        """Wait for a batch to finish and cache its replies; returns how many it answered."""
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            await asyncio.sleep(poll_interval)
+        answered = 0
+        # expired and cancelled batches still return whatever they finished
+        if batch.output_file_id:
+            output = await self.client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    self.cache.set(record["custom_id"], response["body"]["choices"][0]["message"]["content"])
+                    usage = response["body"].get("usage") or {}
+                    self.stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                    self.stats["completion_tokens"] += usage.get("completion_tokens", 0)
+                    answered += 1
+        return answered
+
+    async def run_batch(self, requests: list, state_path: str, poll_interval=60.0, max_batch_requests=50000):
+        """
+        Answer every request in `requests` (a list of (messages, params) pairs, params being extra arguments
+        of `complete` such as response_format) that is not cached yet through the Batch API,
+        and cache the replies. The submitted batches and their request keys are recorded in `state_path`, so a
+        restarted process picks them up and only submits the uncached requests they do not cover. Requests a batch
+        did not answer stay uncached, and are left to live calls (or fail in offline mode).
+        """
+        if self.cache is None:
+            raise ValueError("batch judging delivers its replies through the cache, so it needs a cache_dir")
+        state_file = Path(state_path)
+        state = json.loads(state_file.read_text()) if state_file.exists() else {"batches": []}
+        # requests already in a recorded batch are not submitted again; any other uncached request is
+        submitted = {key for batch in state["batches"] for key in batch.get("keys", ())}
+        pending = {}
+        for messages, params in requests:
+            key = self._key(messages, params)
+            if key not in pending and key not in submitted and self.cache.get(key) is None:
+                pending[key] = self._batch_line(key, messages, params)
+        lines = list(pending.values())
+        for i in range(0, len(lines), max_batch_requests):
+            state["batches"].append(await self._submit_batch(lines[i:i + max_batch_requests]))
+            state_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = state_file.with_suffix(".tmp")
+            tmp_file.write_text(json.dumps(state, indent=2))
+            os.replace(tmp_file, state_file)
+        answered = 0
+        for submitted in state["batches"]:
+            answered += await self._collect_batch(submitted["batch_id"], poll_interval)
+        self.stats["batch_answered"] = self.stats.get("batch_answered", 0) + answered
+        state_file.unlink(missing_ok=True)
+        return answered
+
+    def hit_rate(self) -> float:
+        """Share of calls answered without a request of their own (cached or deduplicated)."""
+        saved = self.stats["cache_hits"] + self.stats["deduplicated"]
+        lookups = saved + self.stats["cache_misses"]
+        return saved / lookups if lookups else 0.0
+
+    async def close(self):
+        await self.client.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -1,17 +1,95 @@
-from datasets import load_dataset
-
-def load_metadata_by_key(key):
-    if key == "aime":
-        dataset_name = "ReasoningTrap/AIME"
-    elif key == "math500":
-        dataset_name = "ReasoningTrap/MATH500"
-    elif key == "puzzle":
-        dataset_name = "ReasoningTrap/PuzzleTrivial"
-    else:
+import os
+from pathlib import Path
+from collections.abc import Mapping
+import pyarrow as pa
+
+DATASETS = {
+    "aime": "ReasoningTrap/AIME",
+    "math500": "ReasoningTrap/MATH500",
+    "puzzle": "ReasoningTrap/PuzzleTrivial",
+}
+METADATA_CACHE_DIR = os.getenv("REASONINGTRAP_METADATA_CACHE", "cache/metadata")
+
+
+def _cache_file(key) -> Path:
+    return Path(METADATA_CACHE_DIR) / f"{key}.arrow"
+
+
+def build_metadata_cache(key) -> Path:
+    """Download the dataset once and store it as an Arrow IPC file that later runs memory-map."""
+    from datasets import load_dataset
+
+    dataset = load_dataset(DATASETS[key], split="train")
+    table = dataset.data.table.combine_chunks()
+    path = _cache_file(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique per process, so that parallel first runs cannot write into each other's file
+    tmp_path = path.with_suffix(f".arrow.{os.getpid()}.tmp")
+    with pa.OSFile(str(tmp_path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    return path
+
+
+class _Row(Mapping):
+    """One problem's metadata; each value is read from its column on access."""
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, column):
+        if column not in self._table._columns:
+            raise KeyError(column)
+        return self._table._column(column)[self._index]
+
+    def __iter__(self):
+        return iter(self._table._columns)
+
+    def __len__(self):
+        return len(self._table._columns)
+
+
+class MetadataTable(Mapping):
+    """
+    Read-only {problem_id: {column: value}} view over a memory-mapped Arrow table.
+    Columns are only converted to Python objects the first time one of their values is read.
+    """
+
+    def __init__(self, table: pa.Table):
+        self._arrow = table
+        self._columns = [c for c in table.column_names if c != "problem_id"]
+        self._decoded = {}
+        self._index = {pid: i for i, pid in enumerate(table.column("problem_id").to_pylist())}
+
+    def _column(self, column):
+        if column not in self._decoded:
+            self._decoded[column] = self._arrow.column(column).to_pylist()
+        return self._decoded[column]
+
+    def __getitem__(self, problem_id):
+        return _Row(self, self._index[problem_id])
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+def load_metadata_by_key(key, columns=None, refresh=False) -> MetadataTable:
+    """
+    Return the metadata of dataset `key` keyed by problem_id, restricted to `columns` if given.
+    The first call downloads the dataset into a local Arrow cache; later calls memory-map it and need no network.
+    `refresh=True` downloads it again, to pick up an updated dataset.
+    """
+    if key not in DATASETS:
         raise ValueError(f"Invalid dataset type: {key}")
-    dataset = load_dataset(dataset_name, split="train")
-    keyed = {
-        ex["problem_id"]: {k: v for k, v in ex.items() if k != "problem_id"}
-        for ex in dataset
-    }
-    return keyed
\ No newline at end of file
+    path = _cache_file(key)
+    if refresh or not path.exists():
+        build_metadata_cache(key)
+    table = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    if columns is not None:
+        table = table.select(["problem_id"] + [c for c in columns if c != "problem_id"])
+    return MetadataTable(table)
@@ -2,6 +2,11 @@
 https://github.com/agentica-project/deepscaler/blob/main/deepscaler/rewards/math_utils/utils.py
 """
 import re
+import math
+import random
+import functools
+from fractions import Fraction
+from collections import Counter
 from pylatexenc import latex2text
 import sympy
 from sympy.parsing import sympy_parser
@@ -163,6 +168,8 @@ def _strip_string(string):
 
 
 # sympy might hang -- we don't care about trying to be lenient in these cases
+# (callers that run grading under a hard timeout, see utils/worker_pool.py, may set SYMPY_GUARDS = False)
+SYMPY_GUARDS = True
 BAD_SUBSTRINGS = ["^{", "^("]
 BAD_REGEXES = ["\^[0-9]+\^", "\^[0-9][0-9]+"]
 TUPLE_CHARS = "()[]"
@@ -180,12 +187,17 @@ def _sympy_parse(expr: str):
     )
 
 
+# Building the converter loads its whole macro table, so it is done once instead of per call.
+_LATEX2TEXT = latex2text.LatexNodes2Text()
+
+
+@functools.lru_cache(maxsize=1 << 14)
 def _parse_latex(expr: str) -> str:
     """Attempts to parse latex to an expression sympy can read."""
     expr = expr.replace("\\tfrac", "\\frac")
     expr = expr.replace("\\dfrac", "\\frac")
     expr = expr.replace("\\frac", " \\frac")  # Play nice with mixed numbers.
-    expr = latex2text.LatexNodes2Text().latex_to_text(expr)
+    expr = _LATEX2TEXT.latex_to_text(expr)
 
     # Replace the specific characters that this parser uses.
     expr = expr.replace("√", "sqrt")
@@ -213,8 +225,11 @@ def _is_int(x: float) -> bool:
         return False
 
 
+_FRAC = re.compile(r"^-?[0-9]+.?/0*[1-9][0-9]*.?$")
+
+
 def _is_frac(expr: str) -> bool:
-    return bool(re.search(r"^-?[0-9]+.?/0*[1-9][0-9]*.?$", expr))
+    return bool(_FRAC.search(expr))
 
 
 def _str_is_int(x: str) -> bool:
@@ -232,34 +247,76 @@ def _str_to_int(x: str) -> bool:
     return int(x)
 
 
+_MIXED_NUMBER = re.compile("([0-9]) +([0-9])")
+_THOUSANDS_COMMA = re.compile("(\d)(,)(\d\d\d)($|\D)")
+
+
 def _inject_implicit_mixed_number(step: str):
     """
     Automatically make a mixed number evalable
     e.g. 7 3/4 => 7+3/4
     """
-    p1 = re.compile("([0-9]) +([0-9])")
-    step = p1.sub("\\1+\\2", step)  ## implicit mults
+    step = _MIXED_NUMBER.sub("\\1+\\2", step)  ## implicit mults
     return step
 
 
 def _strip_properly_formatted_commas(expr: str):
     # We want to be careful because we don't want to strip tuple commas
-    p1 = re.compile("(\d)(,)(\d\d\d)($|\D)")
     while True:
-        next_expr = p1.sub("\\1\\3\\4", expr)
+        next_expr = _THOUSANDS_COMMA.sub("\\1\\3\\4", expr)
         if next_expr == expr:
             break
         expr = next_expr
     return next_expr
 
 
+# Patterns used by `_normalize`, compiled once at import.
+_TEXT_WRAPPER = re.compile("^\\\\text\{(?P<text>.+?)\}$")
+_UNITS = [
+    "degree",
+    "cm",
+    "centimeter",
+    "meter",
+    "mile",
+    "second",
+    "minute",
+    "hour",
+    "day",
+    "week",
+    "month",
+    "year",
+    "foot",
+    "feet",
+    "inch",
+    "yard",
+]
+_UNIT_PATTERNS = [(unit, re.compile(f"{unit}(es)?(s)? *(\^[0-9]+)?")) for unit in _UNITS]
+# Cheap test for "no unit anywhere", which is the common case. When it does match, the units are still stripped
+# one after another: removing one can splice together another ("daminuteys" -> "days" -> ""), which a single
+# alternation would miss.
+_ANY_UNIT = re.compile("|".join(_UNITS))
+_DEGREE_SIGN = re.compile("\^ *\\\\circ")
+_THIN_SPACE = re.compile(",\\\\! *")
+_MINUS_SPACE = re.compile("- *")
+
+
+def _strip_units(expr: str) -> str:
+    if _ANY_UNIT.search(expr) is None:
+        return expr
+    for unit, pattern in _UNIT_PATTERNS:
+        # a pattern cannot match without its unit literally present, so skip the regex engine for the rest
+        if unit in expr:
+            expr = pattern.sub("", expr)
+    return expr
+
+
 def _normalize(expr: str) -> str:
     """Normalize answer expressions."""
     if expr is None:
         return None
 
     # Remove enclosing `\text{}`.
-    m = re.search("^\\\\text\{(?P<text>.+?)\}$", expr)
+    m = _TEXT_WRAPPER.search(expr)
     if m is not None:
         expr = m.group("text")
 
@@ -275,31 +332,13 @@ def _normalize(expr: str) -> str:
     expr = expr.replace("trillion", "*10^12")
     expr = expr.replace("s_n =", "")
     expr = expr.replace("d =", "")
-    for unit in [
-        "degree",
-        "cm",
-        "centimeter",
-        "meter",
-        "mile",
-        "second",
-        "minute",
-        "hour",
-        "day",
-        "week",
-        "month",
-        "year",
-        "foot",
-        "feet",
-        "inch",
-        "yard",
-    ]:
-        expr = re.sub(f"{unit}(es)?(s)? *(\^[0-9]+)?", "", expr)
-    expr = re.sub(f"\^ *\\\\circ", "", expr)
+    expr = _strip_units(expr)
+    expr = _DEGREE_SIGN.sub("", expr)
 
     if len(expr) > 0 and expr[0] == "{" and expr[-1] == "}":
         expr = expr[1:-1]
 
-    expr = re.sub(",\\\\! *", "", expr)
+    expr = _THIN_SPACE.sub("", expr)
     if _is_float(expr) and _is_int(float(expr)):
         expr = str(int(round(float(expr))))
     if "\\" in expr:
@@ -309,7 +348,7 @@ def _normalize(expr: str) -> str:
             pass
 
     # edge case with mixed numbers and negative signs
-    expr = re.sub("- *", "-", expr)
+    expr = _MINUS_SPACE.sub("-", expr)
 
     expr = _inject_implicit_mixed_number(expr)
     expr = expr.replace(" ", "")
@@ -339,6 +378,9 @@ def should_allow_eval(expr: str):
     if count_unknown_letters_in_expr(expr) > 2:
         return False
 
+    if not SYMPY_GUARDS:
+        return True
+
     for bad_string in BAD_SUBSTRINGS:
         if bad_string in expr:
             return False
@@ -350,15 +392,68 @@ def should_allow_eval(expr: str):
     return True
 
 
+# Which tier of `are_equal_under_sympy` settled each pair (per process).
+EQUIVALENCE_TIERS = Counter()
+_RATIONAL = re.compile(r"^-?(0|[1-9][0-9]*)(/[1-9][0-9]*)?$")
+_NUMERIC_POINTS = 3
+_NUMERIC_TOLERANCE = 1e-10
+
+
+def _numerically_different(sympy_diff) -> bool:
+    """
+    True if `sympy_diff` is clearly nonzero at some point, in which case sympy.simplify cannot reduce it to 0.
+    Anything inconclusive (values near zero, non-finite values, evaluation errors) returns False.
+    """
+    symbols = sorted(sympy_diff.free_symbols, key=str)
+    rng = random.Random(0)
+    for _ in range(_NUMERIC_POINTS if symbols else 1):
+        point = {s: sympy.Rational(rng.randint(-97, 97), rng.randint(1, 13)) for s in symbols}
+        try:
+            value = complex(sympy_diff.subs(point).evalf(50))
+        except Exception:
+            continue
+        if not (math.isfinite(value.real) and math.isfinite(value.imag)):
+            continue
+        scale = max([1.0] + [abs(float(n)) for n in sympy_diff.atoms(sympy.Number) if n.is_finite])
+        if abs(value) > _NUMERIC_TOLERANCE * scale:
+            return True
+    return False
+
+
 def are_equal_under_sympy(ground_truth_normalized: str, given_normalized: str):
+    """
+    Tiered check that (ground truth) - (given) simplifies to 0, giving the same verdict as a plain
+    sympy.simplify but settling most pairs before it: exact string match, exact rational arithmetic,
+    high-precision numeric evaluation at random points (which can only prove inequality), then simplify.
+    """
+    expr = f"({ground_truth_normalized})-({given_normalized})"
+    if not should_allow_eval(expr):
+        EQUIVALENCE_TIERS["blocked"] += 1
+        return False
+    if _RATIONAL.match(ground_truth_normalized) and _RATIONAL.match(given_normalized):
+        EQUIVALENCE_TIERS["rational"] += 1
+        return Fraction(ground_truth_normalized) == Fraction(given_normalized)
+    try:
+        sympy_diff = _sympy_parse(expr)
+    except:
+        EQUIVALENCE_TIERS["parse_error"] += 1
+        return False
+    if ground_truth_normalized == given_normalized:
+        EQUIVALENCE_TIERS["string"] += 1
+        return True
+    try:
+        different = _numerically_different(sympy_diff)
+    except Exception:
+        different = False
+    if different:
+        EQUIVALENCE_TIERS["numeric"] += 1
+        return False
+    EQUIVALENCE_TIERS["symbolic"] += 1
     are_equal = False
     try:
-        expr = f"({ground_truth_normalized})-({given_normalized})"
-        if should_allow_eval(expr):
-            sympy_diff = _sympy_parse(expr)
-            simplified = sympy.simplify(sympy_diff)
-            if simplified == 0:
-                are_equal = True
+        simplified = sympy.simplify(sympy_diff)
+        if simplified == 0:
+            are_equal = True
     except:
         pass
     return are_equal
@@ -426,25 +521,26 @@ def extract_boxed_answer(solution: str) -> str:
     solution = remove_boxed(solution)
     return solution
 
-def grade_answer_sympy(given_answer: str, ground_truth: str|list) -> bool:
-    if isinstance(ground_truth, list):
-        for gt in ground_truth:
-            is_correct, ground_truth_normalized, given_normalized = grade_answer_sympy(given_answer, gt)
-            if is_correct:
-                return True, ground_truth_normalized, given_normalized
-        return False, ground_truth_normalized, given_normalized
-    if isinstance(ground_truth, int):
-        ground_truth = str(ground_truth)
-    if isinstance(ground_truth, str):
+class PreparedGroundTruth:
+    """One ground-truth answer normalized, split into elements and classified once, to grade many answers against."""
+
+    def __init__(self, ground_truth: str | int):
+        if isinstance(ground_truth, int):
+            ground_truth = str(ground_truth)
         if len(ground_truth) > 100:
             ground_truth = extract_boxed_answer(ground_truth[-100:])
-        ground_truth_normalized = _normalize(ground_truth)
-        if "infinitely" in ground_truth_normalized:
-            if "infinitely" in given_answer or "infty" in given_answer:
-                return True, ground_truth_normalized, given_answer
-            else:
-                return False, ground_truth_normalized, given_answer
-        given_normalized = _normalize(given_answer)
+        self.normalized = _normalize(ground_truth)
+        # "infinitely many" is checked against the raw answer rather than its normal form
+        self.infinitely = self.normalized is not None and "infinitely" in self.normalized
+        self.elems = split_tuple(self.normalized) if self.normalized is not None else []
+        self.elem_is_frac = [_is_frac(elem) for elem in self.elems]
+        self.elem_is_int = [_str_is_int(elem) for elem in self.elems]
+
+    def grade(self, given_answer: str, given_normalized: str):
+        """(is_correct, ground_truth_normalized, given_normalized), exactly as `grade_answer_sympy` computes it."""
+        ground_truth_normalized = self.normalized
+        if self.infinitely:
+            return "infinitely" in given_answer or "infty" in given_answer, ground_truth_normalized, given_answer
 
         if ground_truth_normalized is None:
             return False, ground_truth_normalized, given_normalized
@@ -455,31 +551,68 @@ def grade_answer_sympy(given_answer: str, ground_truth: str|list) -> bool:
         if len(given_normalized) == 0:
             return False, ground_truth_normalized, given_normalized
 
-        ground_truth_elems = split_tuple(ground_truth_normalized)
         given_elems = split_tuple(given_normalized)
 
-        if len(ground_truth_elems) > 1 and (
+        if len(self.elems) > 1 and (
             ground_truth_normalized[0] != given_normalized[0]
             or ground_truth_normalized[-1] != given_normalized[-1]
         ):
-            is_correct = False
-        elif len(ground_truth_elems) != len(given_elems):
-            is_correct = False
-        else:
-            for ground_truth_elem, given_elem in zip(ground_truth_elems, given_elems):
-                if _is_frac(ground_truth_elem) and _is_frac(given_elem):
-                    # if fractions aren't reduced, then shouldn't be marked as correct
-                    # so, we don't want to allow sympy.simplify in this case
-                    is_correct = ground_truth_elem == given_elem
-                elif _str_is_int(ground_truth_elem) != _str_is_int(given_elem):
-                    # if the ground truth answer is an integer, we require the given answer to be a strict match (no sympy.simplify)
-                    is_correct = False
-                else:
-                    is_correct = are_equal_under_sympy(ground_truth_elem, given_elem)
-                if not is_correct:
+            return False, ground_truth_normalized, given_normalized
+        if len(self.elems) != len(given_elems):
+            return False, ground_truth_normalized, given_normalized
+        for ground_truth_elem, gt_is_frac, gt_is_int, given_elem in zip(
+            self.elems, self.elem_is_frac, self.elem_is_int, given_elems
+        ):
+            if gt_is_frac and _is_frac(given_elem):
+                # if fractions aren't reduced, then shouldn't be marked as correct
+                # so, we don't want to allow sympy.simplify in this case
+                is_correct = ground_truth_elem == given_elem
+            elif gt_is_int != _str_is_int(given_elem):
+                # if the ground truth answer is an integer, we require the given answer to be a strict match (no sympy.simplify)
+                is_correct = False
+            else:
+                is_correct = are_equal_under_sympy(ground_truth_elem, given_elem)
+            if not is_correct:
+                return False, ground_truth_normalized, given_normalized
+        return True, ground_truth_normalized, given_normalized
+
+
+@functools.lru_cache(maxsize=4096)
+def _prepare(ground_truth: str | int | tuple) -> tuple:
+    alternatives = ground_truth if isinstance(ground_truth, tuple) else (ground_truth,)
+    return tuple(PreparedGroundTruth(gt) for gt in alternatives)
+
+
+def prepare_ground_truth(ground_truth: str | int | list) -> tuple:
+    """The PreparedGroundTruth of every alternative of `ground_truth`, memoized across calls."""
+    return _prepare(tuple(ground_truth) if isinstance(ground_truth, list) else ground_truth)
+
+
+def grade_many(answers: list, ground_truth: str | list) -> list:
+    """
+    `grade_answer_sympy(answer, ground_truth)` for every answer, in order. The ground truth is prepared once, and
+    each distinct normalized answer is graded once, since the verdict only depends on the normal form.
+    """
+    prepared = prepare_ground_truth(ground_truth)
+    by_raw_answer = any(gt.infinitely for gt in prepared)
+    normalized, verdicts, results = {}, {}, []
+    for given_answer in answers:
+        if given_answer not in normalized:
+            normalized[given_answer] = _normalize(given_answer)
+        given_normalized = normalized[given_answer]
+        key = given_answer if by_raw_answer else given_normalized
+        if key not in verdicts:
+            for gt in prepared:
+                verdict = gt.grade(given_answer, given_normalized)
+                if verdict[0]:
                     break
+            verdicts[key] = verdict
+        results.append(verdicts[key])
+    return results
 
-    return is_correct, ground_truth_normalized, given_normalized
+
+def grade_answer_sympy(given_answer: str, ground_truth: str|list) -> bool:
+    return grade_many([given_answer], ground_truth)[0]
 
 def grade_answer_mathd(given_answer: str, ground_truth: str) -> bool:
     ground_truth_normalized_mathd = mathd_normalize_answer(ground_truth)
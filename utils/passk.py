@@ -0,0 +1,78 @@
+"""
+Unbiased pass@k (Chen et al., 2021) for a whole result set at once.
+
+pass@k = 1 - C(n-c, k) / C(n, k) for a problem with c correct out of n samples, evaluated as
+1 - prod_{i=n-c+1}^{n} (1 - k/i), which never forms the (huge) binomials.
+"""
+import numpy as np
+
+DEFAULT_KS = [1, 2, 4, 8, 16]
+
+
+def pad_ragged(rows: list) -> tuple[np.ndarray, np.ndarray]:
+    """(correct, mask) bool matrices of shape (n_problems, max_samples) from per-problem lists of verdicts."""
+    width = max((len(row) for row in rows), default=0)
+    correct = np.zeros((len(rows), width), dtype=bool)
+    mask = np.zeros((len(rows), width), dtype=bool)
+    for i, row in enumerate(rows):
+        correct[i, :len(row)] = np.asarray(row, dtype=bool)
+        mask[i, :len(row)] = True
+    return correct, mask
+
+
+def _as_matrix(correct, mask) -> tuple[np.ndarray, np.ndarray]:
+    if not isinstance(correct, np.ndarray):
+        return pad_ragged(correct)
+    correct = np.asarray(correct, dtype=bool).reshape(len(correct), -1)
+    mask = np.ones_like(correct) if mask is None else np.asarray(mask, dtype=bool)
+    return correct, mask
+
+
+def pass_at_k(correct, ks=DEFAULT_KS, mask=None) -> np.ndarray:
+    """
+    Per-problem pass@k, shape (n_problems, len(ks)). `correct` is an (n_problems, n_samples) bool matrix,
+    optionally with a `mask` of the samples that exist, or a list of per-problem verdict lists of any lengths.
+    Entries with k > n are NaN: pass@k is undefined with fewer than k samples.
+    """
+    correct, mask = _as_matrix(correct, mask)
+    n = mask.sum(axis=1)
+    c = (correct & mask).sum(axis=1)
+    i = np.arange(1, correct.shape[1] + 1)
+    # factor i of the product for every problem: the i in (n - c, n]
+    in_product = (i[None, :] > (n - c)[:, None]) & (i[None, :] <= n[:, None])
+    values = np.full((len(n), len(ks)), np.nan)
+    for j, k in enumerate(ks):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            factors = np.where(in_product, 1.0 - k / i[None, :], 1.0)
+        # with fewer than k incorrect samples every draw of k contains a correct one
+        values[:, j] = np.where(n - c < k, 1.0, 1.0 - factors.prod(axis=1))
+        values[n < k, j] = np.nan
+    return values
+
+
+def as_dict(row: np.ndarray, ks=DEFAULT_KS) -> dict:
+    """{"pass@k": value} for the k of one problem's row of `pass_at_k` that are defined."""
+    return {f"pass@{k}": float(v) for k, v in zip(ks, row) if not np.isnan(v)}
+
+
+def aggregate(values: np.ndarray, ks=DEFAULT_KS, n_boot=1000, confidence=0.95, seed=0) -> dict:
+    """
+    Mean over problems of each column of `pass_at_k`, with a percentile bootstrap CI from resampling problems:
+    {k: {"mean", "ci_low", "ci_high", "n_problems"}}. Problems with fewer than k samples are left out of k.
+    """
+    rng = np.random.default_rng(seed)
+    summary = {}
+    for j, k in enumerate(ks):
+        column = values[:, j]
+        column = column[~np.isnan(column)]
+        if len(column) == 0:
+            continue
+        boot = column[rng.integers(0, len(column), size=(n_boot, len(column)))].mean(axis=1)
+        tail = 100 * (1 - confidence) / 2
+        summary[k] = {
+            "mean": float(column.mean()),
+            "ci_low": float(np.percentile(boot, tail)),
+            "ci_high": float(np.percentile(boot, 100 - tail)),
+            "n_problems": len(column),
+        }
+    return summary
@@ -1,6 +1,12 @@
 
+import os
 import re
+import json
+import hashlib
+from pathlib import Path
+from bisect import bisect_left
 from typing import List
+from utils.results_io import load_results
 
 
 def build_prompt(prompt: str, args, tokenizer=None, add_generation_prompt=True, partial_completion=None) -> list[str]:
@@ -17,11 +23,7 @@ def build_prompt(prompt: str, args, tokenizer=None, add_generation_prompt=True,
             enable_thinking=False if "nothink" in args.model else True,
         )
         return prompt
-    header = "Please reason step by step, and put your final answer within \\boxed{}.\n\n" if args.cot else "Put your final answer within \\boxed{}.\n\n"
-    prompt = (
-        header + 
-        f"{prompt} \n\n"
-        )
+    prompt = _add_header(prompt, args)
  
     if "qwen" in args.model and tokenizer is not None:
         try:
@@ -60,36 +62,156 @@ def build_prompt(prompt: str, args, tokenizer=None, add_generation_prompt=True,
     return prompt
 
 
+def _add_header(prompt: str, args) -> str:
+    header = "Please reason step by step, and put your final answer within \\boxed{}.\n\n" if args.cot else "Put your final answer within \\boxed{}.\n\n"
+    return (
+        header + 
+        f"{prompt} \n\n"
+        )
+
+
+def build_prompts(prompts: List[str], args, tokenizer=None) -> list:
+    """
+    Batched `build_prompt`: renders the chat template of every prompt in one apply_chat_template call.
+    Falls back to `build_prompt` one by one if the tokenizer rejects the batch.
+    """
+    if tokenizer is None or not prompts:
+        return [build_prompt(prompt, args, tokenizer) for prompt in prompts]
+    kwargs = dict(add_generation_prompt=True, return_tensors=None, tokenize=False)
+    if "qwen" in args.model:
+        kwargs["enable_thinking"] = False if "nothink" in args.model else True
+    try:
+        return tokenizer.apply_chat_template(
+            [[{"role": "user", "content": _add_header(prompt, args)}] for prompt in prompts], **kwargs
+        )
+    except Exception:
+        return [build_prompt(prompt, args, tokenizer) for prompt in prompts]
+
+
+def cached_build_prompts(questions: dict, args, tokenizer, cache_file=None, with_token_ids=False):
+    """
+    `build_prompts` for {problem_id: question}, returning ({problem_id: prompt}, {problem_id: token_ids} or None).
+    Results are kept in `cache_file` and reused while the questions, model, cot flag and chat template are unchanged,
+    so repeat runs skip templating (and, with `with_token_ids`, tokenization) entirely.
+    """
+    fingerprint = hashlib.sha256(json.dumps({
+        "model": args.model,
+        "cot": args.cot,
+        "chat_template": getattr(tokenizer, "chat_template", None),
+        "questions": questions,
+    }, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    cached = {}
+    if cache_file and Path(cache_file).exists():
+        with open(cache_file, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("fingerprint") != fingerprint:
+            cached = {}
+
+    pids = list(questions.keys())
+    if "prompts" not in cached:
+        prompts = build_prompts([questions[pid] for pid in pids], args, tokenizer)
+        cached = {"fingerprint": fingerprint, "prompts": dict(zip(map(str, pids), prompts))}
+    if with_token_ids and "token_ids" not in cached:
+        texts = [cached["prompts"][str(pid)] for pid in pids]
+        if all(isinstance(text, str) for text in texts):
+            # Same call vLLM makes on a text prompt, so the ids are what it would have computed.
+            cached["token_ids"] = dict(zip(map(str, pids), tokenizer(texts)["input_ids"]))
+
+    if cache_file:
+        Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = f"{cache_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(cached, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+
+    prompts = {pid: cached["prompts"][str(pid)] for pid in pids}
+    token_ids = {pid: cached["token_ids"][str(pid)] for pid in pids} if with_token_ids and "token_ids" in cached else None
+    return prompts, token_ids
+
+
 def generate_problem_restatement(raw, question, tokenizer, idx, device="cuda")->List[str]:
     ids = tokenizer(raw, return_tensors="pt").to(device)["input_ids"]
     prompt = insert_problem_restatement(question, ids, idx, tokenizer)
     return prompt, ids
 
-def generate_budget_force_prompt(partial_completion, question, tokenizer, args, match_type="boxed", device="cuda")->List[str]:
-    ids = tokenizer(partial_completion, return_tensors="pt").to(device)["input_ids"]
+BUDGET_FORCE_SUFFIX = "Considering the limited time by the user, I have to give the solution based on the thinking directly now.\n</think>"
+BOXED_PATTERN = re.compile(r'\\boxed\{((?:[^{}]|(?:\{[^{}]*\}))*)\}')
+_PARTIAL_MARKER = "\x00partial\x00"
+
+
+def _budget_force_template(question, tokenizer, args):
+    """
+    Split the continue_final_message template around the partial completion, so every truncation of one
+    completion is `prefix + truncated + BUDGET_FORCE_SUFFIX` instead of a fresh apply_chat_template call.
+    Returns None when the template does not keep the completion verbatim at the end.
+    """
+    rendered = build_prompt(question, args, tokenizer, partial_completion=_PARTIAL_MARKER)
+    if not isinstance(rendered, str) or not rendered.endswith(_PARTIAL_MARKER) or rendered.count(_PARTIAL_MARKER) != 1:
+        return None
+    return rendered[:-len(_PARTIAL_MARKER)]
+
+
+def _truncation_ends(completion, offsets, match_type, max_tokens):
+    """Character offsets at which `completion` is cut, or None where the cut lies past `max_tokens` tokens."""
+    token_ends = [end for _, end in offsets]
     if match_type == "boxed":
-        boxed_matches = list(re.finditer(r'\\boxed\{((?:[^{}]|(?:\{[^{}]*\}))*)\}', partial_completion))
-        indices = [match.end() for match in boxed_matches] if boxed_matches else []
+        # The regex gives character offsets; the token budget is counted on the token that covers each of them.
+        token_counts = [bisect_left(token_ends, match.end()) + 1 for match in BOXED_PATTERN.finditer(completion)]
     elif type(match_type) == int:
-        indices = [match_type]
+        token_counts = [match_type]
     else:
         raise ValueError(f"Invalid match type: {match_type}")
-    prompts = []
-    for index in indices:
-        if index > 30000:
-            prompts.append(None)
-            continue
-        prompt = insert_budget_force(question, ids, index, tokenizer, args)
-        prompts.append(prompt)
-        
-    return prompts
-        
-def insert_budget_force(question, token_ids, index, tokenizer, args):
-    thinking_budget = "Considering the limited time by the user, I have to give the solution based on the thinking directly now.\n</think>"
-    decoded = tokenizer.decode(token_ids[..., :index][0], skip_special_tokens=True).strip("\n")
-    budget_forced = decoded + thinking_budget
-    prompt = build_prompt(question, args, tokenizer, partial_completion=budget_forced)
-    return prompt
+    return [
+        token_ends[min(count, len(token_ends)) - 1] if 0 < count <= max_tokens and token_ends else None
+        for count in token_counts
+    ]
+
+
+def generate_budget_force_prompts(completions, questions, tokenizer, args, match_type="boxed", max_tokens=30000) -> List[List]:
+    """
+    Budget-forcing prompts for a batch of completions: one prompt per `\\boxed{}` in each completion
+    (or per token index if `match_type` is an int), cutting the trace right after it and forcing </think>.
+    Everything is tokenized once, on CPU, and character offsets are mapped to tokens with the offset mapping.
+    """
+    encoded = tokenizer(list(completions), add_special_tokens=False, return_offsets_mapping=True)
+    prefixes = {}
+    all_prompts = []
+    for completion, question, offsets in zip(completions, questions, encoded["offset_mapping"]):
+        if question not in prefixes:
+            prefixes[question] = _budget_force_template(question, tokenizer, args)
+        prefix = prefixes[question]
+        prompts = []
+        for end in _truncation_ends(completion, offsets, match_type, max_tokens):
+            if end is None:
+                prompts.append(None)
+                continue
+            budget_forced = completion[:end].strip("\n") + BUDGET_FORCE_SUFFIX
+            if prefix is not None:
+                prompts.append(prefix + budget_forced)
+            else:
+                prompts.append(build_prompt(question, args, tokenizer, partial_completion=budget_forced))
+        all_prompts.append(prompts)
+    return all_prompts
+
+
+def generate_budget_force_prompt(partial_completion, question, tokenizer, args, match_type="boxed")->List[str]:
+    return generate_budget_force_prompts([partial_completion], [question], tokenizer, args, match_type=match_type)[0]
+
+
+def build_budget_force_prompts(results_file, metadata, tokenizer, args, type_flag, match_type="boxed") -> dict:
+    """Budget-forcing prompts for every sample of an infer.py results file: {problem_id: [[prompt, ...] per sample]}."""
+    results = load_results(results_file)
+    keys, completions, questions = [], [], []
+    for pid, record in results.items():
+        for raw in record["raw"]:
+            keys.append(pid)
+            completions.append(raw)
+            questions.append(metadata[pid][f"{type_flag}_question"])
+    prompts = generate_budget_force_prompts(completions, questions, tokenizer, args, match_type=match_type)
+    out = {}
+    for pid, sample_prompts in zip(keys, prompts):
+        out.setdefault(pid, []).append(sample_prompts)
+    return out
 
 def insert_problem_restatement(question, token_ids, index, tokenizer):
     problem_restatement = f"Wait, let me check again the problem statement. The problem statement is: {question}.\n\n. Considering the limited time by the user, I have to give the solution based on the thinking directly now.\n</think>"
@@ -0,0 +1,75 @@
+import os
+import json
+from pathlib import Path
+
+
+def checkpoint_path(outfile: str) -> str:
+    """Path of the append-only log that backs a checkpointed run of `outfile`."""
+    return f"{outfile}.ckpt.jsonl"
+
+
+def partial_path(outfile: str) -> str:
+    """Path a streamed (.jsonl) `outfile` is written to until it is complete."""
+    return f"{outfile}.partial"
+
+
+def _truncate_partial_line(path: str) -> None:
+    """Cut off a last line left half-written by a crash so new records append cleanly."""
+    with open(path, "rb") as f:
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    if end != len(data):
+        with open(path, "r+b") as f:
+            f.truncate(end)
+
+
+def iter_records(path: str):
+    """Yield (problem_id, record) from a JSONL log without holding the whole file in memory."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n") or not line.strip():
+                continue
+            record = json.loads(line)
+            yield record.pop("problem_id"), record
+
+
+def load_checkpoint(path: str) -> dict:
+    """Return {problem_id: record} for every problem already appended to the log at `path`."""
+    if not Path(path).exists():
+        return {}
+    _truncate_partial_line(path)
+    return dict(iter_records(path))
+
+
+def load_problem_ids(path: str) -> set:
+    """Like `load_checkpoint`, but only keeps the problem_ids."""
+    if not Path(path).exists():
+        return set()
+    _truncate_partial_line(path)
+    return {pid for pid, _ in iter_records(path)}
+
+
+def load_stage_results(path: str) -> dict:
+    """Return {stage: {problem_id: result}} from a log of eval_pipeline.py's per-(problem, stage) records."""
+    stages = {}
+    if not Path(path).exists():
+        return stages
+    _truncate_partial_line(path)
+    for pid, record in iter_records(path):
+        stages.setdefault(record["stage"], {})[pid] = record["result"]
+    return stages
+
+
+def append_record(fout, problem_id, record: dict) -> None:
+    """Append one finished problem to an open log and force it to disk."""
+    fout.write(json.dumps({"problem_id": problem_id, **record}, ensure_ascii=False) + "\n")
+    fout.flush()
+    os.fsync(fout.fileno())
+
+
+def load_results(path: str) -> dict:
+    """Read an infer.py output file, either the pretty-printed .json or the streamed .jsonl."""
+    if str(path).endswith(".jsonl"):
+        return dict(iter_records(path))
+    with open(path, "r") as f:
+        return json.load(f)
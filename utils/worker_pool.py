@@ -0,0 +1,176 @@
+"""
+A small process pool that enforces a hard per-item timeout.
+
+A task is a list of items; a worker applies `fn` to each item in turn and reports every result as soon as it
+has it. When one item runs longer than `timeout` seconds (e.g. a sympy.simplify that never returns), the worker
+is killed, that item is reported as "timeout", a fresh worker replaces it, and the remaining items of the task
+are handed out again. Each worker talks to the parent over its own pipe, so killing one cannot corrupt the others.
+An item's clock only starts once its worker has started up and run the `initializer`, so slow start-ups (of
+replacements too) never count as timeouts.
+
+Workers are forked from the parent by default. A parent that runs other threads while the pool is in use should
+pass start_method="forkserver" (with `preload` modules to keep worker start-up cheap), so that replacement workers
+do not inherit locks held by those threads; module state the workers need must then be set by the `initializer`.
+Every forkserver worker still re-runs the main script, so `preload` should name the modules it imports (preloading
+"__main__" is silently ignored on Python 3.11), or the script should import heavy libraries lazily.
+"""
+import time
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import wait
+
+
+def _worker_loop(conn, fn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    conn.send((None, None, "ready", None))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        task_index, start, items = message
+        for item_index, item in enumerate(items, start):
+            try:
+                conn.send((task_index, item_index, "ok", fn(item)))
+            except Exception as e:
+                conn.send((task_index, item_index, "error", repr(e)))
+        conn.send((task_index, None, "done", None))
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, ctx, fn, initializer, initargs):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_loop, args=(child_conn, fn, initializer, initargs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.spawned = time.monotonic()
+        self.ready = False  # set once the worker has started up and run the initializer
+        self.task = None  # (task_index, next_item_index, items) while busy
+        self.timeout = None
+        self.started = None  # when the current item was handed over, or the worker became ready
+        self.deadline = None  # None until the worker is ready
+
+    def submit(self, task_index, start, items, timeout):
+        self.task = (task_index, start, items)
+        self.timeout = timeout
+        self.started = self.deadline = None
+        if self.ready:
+            self.arm()
+        self.conn.send((task_index, start, items[start:]))
+
+    def arm(self):
+        """Start the clock of the current item."""
+        self.started = time.monotonic()
+        self.deadline = self.started + self.timeout
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SupervisedPool:
+    """
+    Usage:
+        with SupervisedPool(fn, processes=10, timeout=10) as pool:
+            for task_index, item_index, status, value in pool.run(tasks):
+                ...
+    `status` is "ok" (value = fn(item)), "error" (value = repr of the exception) or "timeout" (value = None).
+    `latencies[(task_index, item_index)]` is the wall time each item took, as seen from the parent, and
+    `startups` holds the (spawned, ready) monotonic times of every worker that has come up, replacements included.
+    """
+
+    def __init__(self, fn, processes, timeout, initializer=None, initargs=(), start_method="fork", preload=()):
+        self.fn = fn
+        self.processes = processes
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self.ctx = mp.get_context(start_method)
+        if preload:
+            self.ctx.set_forkserver_preload(list(preload))
+        self.workers = []
+        self.num_timeouts = 0
+        self.num_restarts = 0
+        self.latencies = {}
+        self.startups = []
+
+    def _spawn(self):
+        return _Worker(self.ctx, self.fn, self.initializer, self.initargs)
+
+    def __enter__(self):
+        self.workers = [self._spawn() for _ in range(self.processes)]
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        self.workers = []
+
+    def _replace(self, worker):
+        worker.kill()
+        self.num_restarts += 1
+        replacement = self._spawn()
+        self.workers[self.workers.index(worker)] = replacement
+        return replacement
+
+    def run(self, tasks):
+        """Yield (task_index, item_index, status, value) for every item of every task, in completion order."""
+        queue = deque((task_index, 0, list(items)) for task_index, items in enumerate(tasks) if len(items))
+        while queue or any(worker.task is not None for worker in self.workers):
+            for worker in self.workers:
+                if worker.task is None and queue:
+                    worker.submit(*queue.popleft(), self.timeout)
+            busy = [worker for worker in self.workers if worker.task is not None]
+            deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+            wait_for = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            ready = wait([worker.conn for worker in busy], timeout=wait_for)
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        task_index, item_index, status, value = worker.conn.recv()
+                    except (EOFError, OSError):
+                        # the worker died on its own (segfault, OOM kill): blame the item it was on
+                        yield from self._abandon(worker, queue, "error", "worker died")
+                        continue
+                    if status == "ready":
+                        worker.ready = True
+                        worker.arm()
+                        self.startups.append((worker.spawned, worker.started))
+                        continue
+                    if status == "done":
+                        worker.task = None
+                        continue
+                    now = time.monotonic()
+                    self.latencies[(task_index, item_index)] = now - worker.started
+                    worker.task = (task_index, item_index + 1, worker.task[2])
+                    worker.started = now
+                    worker.deadline = now + self.timeout
+                    yield task_index, item_index, status, value
+                elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+                    self.num_timeouts += 1
+                    yield from self._abandon(worker, queue, "timeout", None)
+
+    def _abandon(self, worker, queue, status, value):
+        task_index, item_index, items = worker.task
+        if worker.started is not None:
+            self.latencies[(task_index, item_index)] = time.monotonic() - worker.started
+        self._replace(worker)
+        if item_index + 1 < len(items):
+            queue.appendleft((task_index, item_index + 1, items))
+        yield task_index, item_index, status, value